@@ -0,0 +1,36 @@
+from vision import model
+from vision.track import dp
+from vision.toymaker import *
+import random
+import time
+
+# times dp.track with and without the coarse pass on a toy video with
+# distractors, and reports how far the coarse paths stray from the full one
+
+random.seed(0)
+
+g = Geppetto((640, 480))
+b = Rectangle((50, 60), (60, 60), "red")
+b = b.linear((500, 380), 60)
+g.add(b)
+for k in range(4):
+    r = Rectangle((random.randint(0, 560), random.randint(0, 400)), (60, 60),
+                  ["blue", "green"][k % 2])
+    g.add(r.linear((random.randint(0, 560), random.randint(0, 400)), 60))
+
+path = b.groundtruth()
+svm = model.PathModel(g, [path[0], path[-1]], bgsize = 2000)
+
+def run(**kwargs):
+    start = time.time()
+    result = dp.track(path[0], path[-1], svm, g, skip = 3, **kwargs)
+    return time.time() - start, result
+
+full, expected = run()
+print "full grid: {0:.2f} s".format(full)
+for coarse, shrink in [(12, 2), (12, 4), (24, 4)]:
+    elapsed, predicted = run(coarse = coarse, shrink = shrink)
+    drift = max(max(abs(x.xtl - y.xtl), abs(x.ytl - y.ytl))
+                for x, y in zip(expected, predicted))
+    print "coarse {0}, shrink {1}: {2:.2f} s, largest drift {3} px".format(
+          coarse, shrink, elapsed, drift)
@@ -0,0 +1,48 @@
+from vision.track import dp, pairwise
+import numpy
+import time
+
+# times one frame of the forward pass of the dynamic program with the
+# original per cell unary loop and with the vectorized gather
+
+dim = (40, 40)
+box = (100, 100)
+repeats = 10
+
+def best(function, *args):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        function(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+for width, height in [(640, 480), (1280, 720)]:
+    wr = dim[0] / float(box[0])
+    hr = dim[1] / float(box[1])
+    costs = numpy.random.randn(int(width * wr) - dim[0],
+                               int(height * hr) - dim[1]) * 5
+    for skip in [1, 3]:
+        shape = (int(numpy.ceil((width - box[0]) / float(skip))),
+                 int(numpy.ceil((height - box[1]) / float(skip))))
+        previous = numpy.random.rand(*shape)
+        transform = pairwise.Quadratic(0.001)
+        grid = dp.unarygrid(shape, wr, hr, skip)
+
+        current = numpy.zeros(shape)
+        expected = current.copy()
+        dp.unary(current, costs, grid, 10, -100)
+        dp.unaryreference(expected, costs, wr, hr, skip, 10, -100)
+        assert numpy.all(current == expected)
+
+        before = best(dp.unaryreference, current, costs, wr, hr, skip, 10, -100)
+        after = best(dp.unary, current, costs, grid, 10, -100)
+        pairwisetime = best(transform, previous)
+
+        print "{0}x{1} skip {2}: {3} cells".format(width, height, skip,
+                                                    shape[0] * shape[1])
+        print "    unary before {0:.2f} ms, after {1:.2f} ms".format(
+              before * 1000, after * 1000)
+        print "    forward pass per frame before {0:.2f} ms, " \
+              "after {1:.2f} ms".format((before + pairwisetime) * 1000,
+                                        (after + pairwisetime) * 1000)
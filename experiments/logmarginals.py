@@ -0,0 +1,61 @@
+from vision import model
+from vision.track import dp
+from vision.alearn import marginals
+from vision.toymaker import *
+import numpy
+
+# checks the marginals with float32 messages against float64 on toy videos
+# and reports the memory the forward messages take in each precision
+
+def toys():
+    g = Geppetto((320, 240))
+    b = Rectangle((20, 20), (40, 40), "red")
+    b = b.linear((250, 150), 60)
+    g.add(b)
+    yield "linear", g, b
+
+    g = Geppetto((320, 240))
+    b = Rectangle((20, 20), (50, 30), "blue")
+    b = b.linear((250, 20), 20)
+    b = b.linear((30, 180), 40)
+    b = b.linear((250, 180), 60)
+    g.add(b)
+    yield "zigzag", g, b
+
+    g = Geppetto((320, 240))
+    b = Rectangle((150, 100), (40, 60), "green")
+    b = b.linear((160, 110), 60)
+    g.add(b)
+    yield "still", g, b
+
+for name, g, b in toys():
+    path = b.groundtruth()
+    start, stop = path[0], path[59]
+    svm = model.PathModel(g, [start, stop], bgsize = 2000)
+
+    results = {}
+    for dtype in [numpy.float64, numpy.float32]:
+        results[dtype] = marginals.picksegment(start, stop, svm, g,
+                                               dtype = dtype)
+
+    before = dict((x[1], x[0]) for x in results[numpy.float64][0])
+    after = dict((x[1], x[0]) for x in results[numpy.float32][0])
+    difference = max(abs(before[x] - after[x]) / max(abs(before[x]), 1e-12)
+                     for x in before)
+    samepath = ([x[0:4] for x in results[numpy.float64][1]] ==
+                [x[0:4] for x in results[numpy.float32][1]])
+
+    costs = dict(dp.scoreframe((g, start, x, svm)) for x in range(60))
+    memory = {}
+    for dtype in [numpy.float64, numpy.float32]:
+        graph = dp.buildgraph(range(60), g[0].size, svm, costs, 0.001, 10,
+                              -100, 3, [start, stop], dtype = dtype)
+        memory[dtype] = sum(x[0].nbytes for x in graph.values())
+
+    print "{0}: largest relative difference {1:.2e}, same pick {2}, " \
+          "same path {3}".format(name, difference,
+                                 max(results[numpy.float64][0])[1] ==
+                                 max(results[numpy.float32][0])[1],
+                                 samepath)
+    print "    messages take {0} bytes in float64 and {1} in float32".format(
+          memory[numpy.float64], memory[numpy.float32])
@@ -0,0 +1,55 @@
+from vision import model
+from vision.track import dp
+from vision.alearn import marginals
+from vision.toymaker import *
+import time
+
+# times scoremarginals against the original per cell loop over a 100 frame
+# synthetic segment and checks that both give the same marginals
+
+g = Geppetto((640, 480))
+b = Rectangle((50, 50), (60, 60), "red")
+b = b.linear((400, 300), 50)
+b = b.linear((100, 350), 100)
+g.add(b)
+
+path = b.groundtruth()
+start, stop = path[0], path[99]
+frames = range(start.frame, stop.frame + 1)
+skip = 3
+radius = 10
+sigma = .1
+
+svm = model.PathModel(g, [start, stop], bgsize = 2000)
+costs = dict(dp.scoreframe((g, start, x, svm)) for x in frames)
+
+args = [frames, g[0].size, svm, costs, 0.001, 10, -100, skip, [start, stop]]
+forwards = dp.buildgraph(*args)
+args[0] = list(reversed(frames))
+backwards = dp.buildgraph(*args)
+
+predicted = dp.backtrack(forwards, start, stop, stop.frame, skip, True)
+pathdict = dict((x.frame, x) for x in predicted)
+forwarderror = marginals.calcerror(pathdict, forwards, 0.5, skip, frames)
+backwarderror = marginals.calcerror(pathdict, backwards, 0.5, skip,
+                                    list(reversed(frames)))
+
+orders = [(forwards[x], backwards[x], forwarderror[x], backwarderror[x],
+           costs[x], sigma, svm.dim, start, skip, radius, x)
+          for x in frames[1:-1]]
+
+begin = time.time()
+before = map(marginals.scoremarginalsreference, orders)
+before_time = time.time() - begin
+
+begin = time.time()
+after = map(marginals.scoremarginals, orders)
+after_time = time.time() - begin
+
+difference = max(abs(x[0] - y[0]) / max(abs(x[0]), 1e-12)
+                 for x, y in zip(before, after))
+print "{0} frames of {1} cells".format(len(orders), forwards[1][0].size)
+print "before: {0:.2f} ms per frame".format(before_time / len(orders) * 1000)
+print "after:  {0:.2f} ms per frame".format(after_time / len(orders) * 1000)
+print "largest relative difference: {0}".format(difference)
+print "same pick: {0}".format(max(before)[1] == max(after)[1])
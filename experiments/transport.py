@@ -0,0 +1,49 @@
+from vision import model
+from vision.track import dp
+from vision.toymaker import *
+from vision.sharedmem import SharedFrames, SharedCosts
+import multiprocessing
+import cPickle as pickle
+import time
+
+# measures how many bytes the scoring work orders of dp.track pickle per
+# frame when frames and cost maps are pickled and when they are shared
+
+g = Geppetto((1280, 720))
+b = Rectangle((100, 100), (80, 80), "red")
+b = b.linear((900, 500), 50)
+g.add(b)
+
+path = b.groundtruth()
+frames = range(0, 50)
+svm = model.PathModel(g, [path[0], path[-1]], bgsize = 2000)
+
+# frames decoded up front, so the sizes below count pixels, not toys
+decoded = [g[x] for x in frames]
+
+def size(x):
+    return len(pickle.dumps(x, pickle.HIGHEST_PROTOCOL))
+
+start = path[0]
+frame = 25
+
+order = (decoded, start, frame, svm, None)
+result = dp.scoreframe(order)
+print "before: {0} bytes sent, {1} bytes returned per frame".format(
+      size(order), size(result))
+
+with SharedFrames(decoded, frames, eager = True) as sharedframes:
+    with SharedCosts() as results:
+        order = (sharedframes, start, frame, svm, None, results)
+        result = dp.scoreframe(order)
+        print "after:  {0} bytes sent, {1} bytes returned per frame".format(
+              size(order), size(result))
+
+# the toy video renders frames on demand, as a video on disk decodes them,
+# so with shared the workers decode in parallel into the shared frames
+pool = multiprocessing.Pool(multiprocessing.cpu_count())
+for shared in [False, True]:
+    begin = time.time()
+    dp.track(path[0], path[-1], svm, g, pool = pool, shared = shared)
+    print "track with shared = {0}: {1:.2f} s".format(shared,
+                                                      time.time() - begin)
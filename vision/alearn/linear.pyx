@@ -1,36 +1,67 @@
 import math, logging, multiprocessing, numpy
 from vision import annotations, convolution, model
 from vision.track import interpolation
+from vision.pyramid import PyramidCache
+from vision.sharedmem import SharedFrames, SharedObject
 
 cimport numpy
 from vision cimport annotations
 
-cdef extern from "math.h":
-    float exp(float n)
-
 log = logging.getLogger("vision.track.alearn")
 
 def pick(images, path, dim = (40, 40), errortube = 100,
          double sigma = 0.1, bgskip = 4, bgsize = 5e4,
-         skip = 1, plot = False, pool = None):
+         skip = 1, plot = False, pool = None, pyramids = None,
+         shared = False, chunksize = 10):
     """
     Given a path, picks the most informative frame that we currently lack.
+
+    Frames are scored in chunks of up to chunksize consecutive frames per
+    task. With a pool, the model is pickled once and each worker loads it
+    once, rather than once per frame. If shared and there is a pool, the
+    frames travel to the workers through shared memory instead of being
+    pickled.
     """
     log.info("Picking most informative frame through active learning")
     svm = model.PathModel(images, path, dim = dim,
                           bgskip = bgskip, bgsize = bgsize)
     scores = []
 
-    log.info("Scoring frames")
-    for prev, cur in zip(path, path[1:]):
-        lpath = interpolation.Linear(prev, cur)[1:-1:skip]
-        workorders = [(x, images, svm, prev, cur, 
-                       dim, errortube, sigma, plot) for x in lpath]
+    sharedframes = None
+    sharedmodel = None
+    try:
+        if pool:
+            sharedmodel = SharedObject(svm)
+            svm = sharedmodel
+        if pool and shared:
+            frames = [x.frame for prev, cur in zip(path, path[1:])
+                      for x in interpolation.Linear(prev, cur)[1:-1:skip]]
+            if frames:
+                images = sharedframes = SharedFrames(images, frames)
+                if pyramids is not None:
+                    pyramids = PyramidCache(images, pyramids.sbin,
+                                            pyramids.interval,
+                                            pyramids.capacity)
+
+        log.info("Scoring frames")
+        workorders = []
+        for prev, cur in zip(path, path[1:]):
+            lpath = interpolation.Linear(prev, cur)[1:-1:skip]
+            for i in range(0, len(lpath), chunksize):
+                workorders.append((lpath[i:i + chunksize], images, svm, prev,
+                                   cur, dim, errortube, sigma, plot,
+                                   pyramids))
         if pool:
-            scores.extend(pool.map(score_frame_do, workorders))
+            results = pool.map(score_frames_do, workorders)
         else:
-            for workorder in workorders:
-                scores.append(score_frame_do(workorder))
+            results = map(score_frames_do, workorders)
+        for result in results:
+            scores.extend(result)
+    finally:
+        if sharedframes is not None:
+            sharedframes.close()
+        if sharedmodel is not None:
+            sharedmodel.close()
 
     best = max([min(x) for x in zip(*[scores[y:] for y in range(25)])])[1]
 
@@ -44,12 +75,20 @@ def pick(images, path, dim = (40, 40), errortube = 100,
 
     return best
 
-def score_frame_do(workorder):
-    return score_frame(*workorder), workorder[0].frame
+def score_frames_do(workorder):
+    """
+    Scores a chunk of frames and returns a list of (score, frame).
+    """
+    linearboxes, images, svm = workorder[0:3]
+    if isinstance(svm, SharedObject):
+        svm = svm.get()
+    return [(score_frame(x, images, svm, *workorder[3:]), x.frame)
+            for x in linearboxes]
     
 def score_frame(annotations.Box linearbox, images, svm,
                 annotations.Box previous, annotations.Box current, dim,
-                int errortube, double sigma = 10, plot = False):
+                int errortube, double sigma = 10, plot = False,
+                pyramids = None):
     """
     Scores an individual frame to determine its usefulness. A higher score
     is more useful than a lower score from a different frame.
@@ -59,14 +98,18 @@ def score_frame(annotations.Box linearbox, images, svm,
     cdef double wr = (<float>dim[0]) / linearbox.width
     cdef double hr = (<float>dim[1]) / linearbox.height
 
-    im = images[linearbox.frame]
-    im = im.resize((int(im.size[0] * wr), int(im.size[1] * hr)))
-
-    cdef int w = im.size[0] - dim[0]
-    cdef int h = im.size[1] - dim[1]
+    if pyramids is not None:
+        pyramid = pyramids[linearbox.frame]
+        im = pyramid.image
+    else:
+        pyramid = None
+        im = images[linearbox.frame]
 
     cdef numpy.ndarray[numpy.double_t, ndim=2] costim
-    costim = convolution.hogrgb(im, dim, svm.hogweights(), svm.rgbweights())
+    costim = svm.scoreframe(im, linearbox.size, pyramid = pyramid)
+
+    cdef int w = costim.shape[0]
+    cdef int h = costim.shape[1]
 
     pstartx = linearbox.xtl - errortube
     pstopx  = linearbox.xtl + errortube
@@ -84,42 +127,38 @@ def score_frame(annotations.Box linearbox, images, svm,
 
     cdef double framearea = (w/wr) * (h/hr)
     cdef int framedifference = current.frame - previous.frame
-    score = 0
-    normalizer = 0
-
-    cdef numpy.ndarray[numpy.double_t, ndim=2] dlinearim = numpy.zeros((w, h))
-    cdef numpy.ndarray[numpy.double_t, ndim=2] dprobim = numpy.zeros((w, h))
-    cdef numpy.ndarray[numpy.double_t, ndim=2] dscoreim = numpy.zeros((w, h))
-
-    cdef double lineardiffy, lineardiffx, lineardiff
-    cdef int i, j
-    for i in range(pstartx, pstopx):
-        for j in range(pstarty, pstopy): 
-            # calculate area difference through cross product
-            lineardiffy  = current.xtl - previous.xtl
-            lineardiffy *= linearbox.frame - previous.frame
-            lineardiffy -= (i / wr - previous.xtl) * framedifference
-
-            lineardiffx  = current.ytl - previous.ytl
-            lineardiffx *= linearbox.frame - previous.frame
-            lineardiffx -= (j / hr - previous.ytl) * framedifference
-
-            lineardiff   = lineardiffx * lineardiffx
-            lineardiff  += lineardiffy * lineardiffy 
-
-            # compute local score
-            matchscore   = exp(-costim[i,j] / sigma)
-            localscore   = matchscore * lineardiff
-            # store for total score
-            score       += localscore 
-            normalizer  += matchscore
-
-            dlinearim[i,j] = lineardiff
-            dprobim[i,j] = matchscore
-            dscoreim[i,j] = localscore
+
+    # calculate area difference through cross product, along each axis
+    i = numpy.arange(pstartx, pstopx)
+    j = numpy.arange(pstarty, pstopy)
+    lineardiffy  = (current.xtl - previous.xtl) * \
+                   (linearbox.frame - previous.frame)
+    lineardiffy -= (i / wr - previous.xtl) * framedifference
+    lineardiffx  = (current.ytl - previous.ytl) * \
+                   (linearbox.frame - previous.frame)
+    lineardiffx -= (j / hr - previous.ytl) * framedifference
+    lineardiff = (lineardiffx * lineardiffx)[None, :] + \
+                 (lineardiffy * lineardiffy)[:, None]
+
+    # compute local scores, relative to the best match in the window so
+    # they cannot all underflow; score and normalizer scale alike
+    window = slice(pstartx, pstopx), slice(pstarty, pstopy)
+    region = costim[window]
+    best = region.min() if region.size else 0
+    matchscore = numpy.exp(-(region - best) / sigma)
+    localscore = matchscore * lineardiff
+    score = float(localscore.sum())
+    normalizer = float(matchscore.sum())
 
     if plot:
         import matplotlib.pyplot as plt
+        dlinearim = numpy.zeros((w, h))
+        dprobim = numpy.zeros((w, h))
+        dscoreim = numpy.zeros((w, h))
+        dlinearim[window] = lineardiff
+        dprobim[window] = matchscore
+        dscoreim[window] = localscore
+
         plt.subplot(221)
         plt.set_cmap("gray")
         plt.imshow(dprobim.transpose() / normalizer)
@@ -3,6 +3,7 @@ from vision import Box
 from vision.track import interpolation
 from vision.track import dp
 from vision.model import PathModel
+from multiprocessing.pool import ThreadPool
 import logging
 import numpy
 
@@ -25,11 +26,49 @@ cdef double Infinity = 1e300
 def pick(givens, images, last = None, 
          pairwisecost = 0.001, upperthreshold = 10, lowerthreshold = -100,
          sigma = .1, erroroverlap = 0.5, skip = 3, dim = (40, 40), 
-         rgbbin = 8, hogbin = 8, c = 1, clickradius = 10, pool = None):
+         rgbbin = 8, hogbin = 8, c = 1, clickradius = 10, pool = None,
+         pyramids = None, shared = False, cache = None,
+         dtype = numpy.double):
+    """
+    Tracks through the givens and returns the most informative frame to
+    annotate next, its score, the predicted path and the marginals.
+
+    If a SegmentCache is given, the model and the results of segments that
+    the new givens did not split are reused, so a new click only solves the
+    two segments it splits. See SegmentCache for how exact that is.
+
+    dtype sets the storage precision of the messages and errors, see
+    picksegment().
+    """
 
     givens.sort(key = lambda x: x.frame)
 
-    model = PathModel(images, givens, rgbbin = rgbbin, hogbin = hogbin, c = c)
+    if cache is not None:
+        model = cache.learn(images, givens, rgbbin = rgbbin, hogbin = hogbin,
+                            c = c)
+    else:
+        model = PathModel(images, givens, rgbbin = rgbbin, hogbin = hogbin,
+                          c = c)
+
+    options = (pairwisecost, upperthreshold, lowerthreshold, sigma,
+               erroroverlap, skip, clickradius, numpy.dtype(dtype).str)
+
+    used = []
+    def solve(start, stop):
+        if cache is not None:
+            key = (segmentkey(start), segmentkey(stop), options)
+            used.append(key)
+            if key in cache.segments:
+                logger.info("Reusing segment {0} to {1}"
+                            .format(start.frame, key[1][-1]))
+                return cache.segments[key]
+        result = picksegment(start, stop, model, images, pairwisecost,
+                             upperthreshold, lowerthreshold, sigma,
+                             erroroverlap, skip, clickradius, pool, pyramids,
+                             shared = shared, cache = cache, dtype = dtype)
+        if cache is not None:
+            cache.segments[key] = result
+        return result
     
     fullpath = []
     fullmarginals = []
@@ -37,22 +76,19 @@ def pick(givens, images, last = None,
         if x.frame == y.frame:
             raise RuntimeError("Frame {0} appears twice".format(x.frame))
         logger.info("Scoring {0} to {1}".format(x.frame, y.frame))
-        marginals, path = picksegment(x, y, model, images, pairwisecost,
-                                        upperthreshold, lowerthreshold,
-                                        sigma, erroroverlap,
-                                        skip, clickradius, pool)
+        marginals, path = solve(x, y)
         fullpath.extend(path[:-1])
         fullmarginals.extend(marginals[:-1])
 
     if last is not None and last >= givens[-1].frame:
         logger.info("Scoring {0} to last at {1}".format(givens[-1].frame, last))
-        marginals, path = picksegment(givens[-1], last, model, images,
-                                      pairwisecost, upperthreshold,
-                                      lowerthreshold, sigma,
-                                      erroroverlap, skip, clickradius, pool)
+        marginals, path = solve(givens[-1], last)
         fullpath.extend(path[:-1])
         fullmarginals.extend(marginals)
 
+    if cache is not None:
+        cache.keep(used)
+
     if debug:
         pylab.plot([x[1] for x in fullmarginals],
                    [x[0] for x in fullmarginals])
@@ -67,7 +103,28 @@ def pick(givens, images, last = None,
 def picksegment(start, stop, model, images,
                pairwisecost = 0.001, upperthreshold = 10,
                lowerthreshold = -100, sigma = .1, erroroverlap = 0.5, skip = 3,
-               clickradius = 10, pool = None):
+               clickradius = 10, pool = None, pyramids = None,
+               concurrent = True, shared = False, cache = None,
+               dtype = numpy.double):
+    """
+    Tracks start to stop and scores the marginals of every frame between.
+
+    If a SegmentCache is given, cost maps it holds for these frames and box
+    size are used instead of scoring the frames again.
+
+    If shared and there is a pool, frames and cost maps travel to and from
+    the workers through shared memory instead of being pickled.
+
+    If concurrent, the forward and backward passes, and then their errors,
+    run in two threads. The distance transforms and most array work
+    release the GIL, so this overlaps most of the work.
+
+    The forward and backward messages and the errors are stored as dtype,
+    so numpy.float32 halves their memory. This only changes the storage:
+    the dynamic program still runs in double precision, see
+    dp.buildgraph(). The marginals are normalized in log space, shifted by
+    the best score, so they stay stable in either precision.
+    """
 
     if pool:
         logger.info("Found a process pool, so attempting to parallelize")
@@ -112,77 +169,100 @@ def picksegment(start, stop, model, images,
     # build dictionary of local scores
     # if there is a pool, this will happen in parallel
     logger.info("Scoring frames")
-    orders = [(images, start, x, model) for x in frames]
-    costs = dict(mapper(dp.scoreframe, orders))
+    costs = {}
+    if cache is not None:
+        costs = cache.getcosts(frames, start.size)
+    missing = [x for x in frames if x not in costs]
+    if not missing:
+        pass
+    elif pool and shared:
+        costs.update(dp.scoreshared(pool, images, start, missing, model,
+                                    pyramids))
+    else:
+        orders = [(images, start, x, model, pyramids) for x in missing]
+        costs.update(mapper(dp.scoreframe, orders))
+    if cache is not None:
+        cache.putcosts(costs, start.size)
 
     # forward and backwards passes
     # if there is a pool, this will use up to 2 cores
     forwardsargs  = [frames, imagesize, model, costs, pairwisecost,
-                     upperthreshold, lowerthreshold, skip, constraints]
+                     upperthreshold, lowerthreshold, skip, constraints,
+                     False, None, dtype]
     backwardsargs = list(forwardsargs)
     backwardsargs[0] = list(reversed(frames))
-    if False and pool:
-        logger.info("Building forwards and backwards graphs")
-        forwards  = pool.apply_async(dp.buildgraph, forwardsargs)
-        backwards = dp.buildgraph(*backwardsargs)
-        forwards  = forwards.get() # blocks until forwards graph done
-    else:
-        logger.info("Building forwards graph")
-        forwards  = dp.buildgraph(*forwardsargs)
-        logger.info("Building backwards graph")
-        backwards = dp.buildgraph(*backwardsargs)
-    
-    # backtrack
-    logger.info("Backtracking")
-    if constrained:
-        x, y, frame = stop.xtl, stop.ytl, stop.frame
-    else:
-        x, y = numpy.unravel_index(numpy.argmin(forwards[stopframe][0]),
-                                                forwards[stopframe][0].shape)
-        x = x * skip
-        y = y * skip
-        frame = stopframe
-    path = []
-    while frame > start.frame:
-        path.append(annotations.Box(x, y,
-                                    x + start.width,
-                                    y + start.height,
-                                    frame))
-        x, y = (forwards[frame][1][x // skip, y // skip] * skip,
-                forwards[frame][2][x // skip, y // skip] * skip)
-        frame = frame - 1
-    path.append(start)
-    path.reverse()
-    pathdict = dict((x.frame, x) for x in path)
-
-    # calculating error
-    # if there is a pool, this will use up to 2 cores
-    if False and pool:
-        logger.info("Calculating forward and backwards errors")
-        forwarderror  = pool.apply_async(calcerror, (pathdict,
-                                                     forwards,
-                                                     erroroverlap,
-                                                     skip,
-                                                     frames))
-        backwarderror = calcerror(pathdict,
-                                  backwards,
-                                  erroroverlap,
-                                  skip,
-                                  list(reversed(frames)))
-        forwarderror  = forwarderror.get() # blocks until forwards is done
-    else:
-        logger.info("Calculating forward error")
-        forwarderror  = calcerror(pathdict,
-                                  forwards,
-                                  erroroverlap,
-                                  skip,
-                                  frames)
-        logger.info("Calculating backward error")
-        backwarderror = calcerror(pathdict,
-                                  backwards,
-                                  erroroverlap,
-                                  skip,
-                                  list(reversed(frames)))
+    threads = ThreadPool(1) if concurrent else None
+    try:
+        if concurrent:
+            logger.info("Building forwards and backwards graphs")
+            forwards  = threads.apply_async(dp.buildgraph, forwardsargs)
+            backwards = dp.buildgraph(*backwardsargs)
+            forwards  = forwards.get() # blocks until forwards graph done
+        else:
+            logger.info("Building forwards graph")
+            forwards  = dp.buildgraph(*forwardsargs)
+            logger.info("Building backwards graph")
+            backwards = dp.buildgraph(*backwardsargs)
+
+        # backtrack
+        logger.info("Backtracking")
+        if constrained:
+            x, y, frame = stop.xtl, stop.ytl, stop.frame
+        else:
+            last = forwards[stopframe][0]
+            x, y = numpy.unravel_index(numpy.argmin(last), last.shape)
+            x = x * skip
+            y = y * skip
+            frame = stopframe
+        path = []
+        while frame > start.frame:
+            path.append(annotations.Box(x, y,
+                                        x + start.width,
+                                        y + start.height,
+                                        frame))
+            x, y = (forwards[frame][1][x // skip, y // skip] * skip,
+                    forwards[frame][2][x // skip, y // skip] * skip)
+            frame = frame - 1
+        path.append(start)
+        path.reverse()
+        pathdict = dict((x.frame, x) for x in path)
+
+        # calculating error
+        # if there is a pool, this will use up to 2 cores
+        if concurrent:
+            logger.info("Calculating forward and backwards errors")
+            forwarderror  = threads.apply_async(calcerror, (pathdict,
+                                                         forwards,
+                                                         erroroverlap,
+                                                         skip,
+                                                         frames,
+                                                         dtype))
+            backwarderror = calcerror(pathdict,
+                                      backwards,
+                                      erroroverlap,
+                                      skip,
+                                      list(reversed(frames)),
+                                      dtype)
+            forwarderror  = forwarderror.get() # blocks until forwards is done
+        else:
+            logger.info("Calculating forward error")
+            forwarderror  = calcerror(pathdict,
+                                      forwards,
+                                      erroroverlap,
+                                      skip,
+                                      frames,
+                                      dtype)
+            logger.info("Calculating backward error")
+            backwarderror = calcerror(pathdict,
+                                      backwards,
+                                      erroroverlap,
+                                      skip,
+                                      list(reversed(frames)),
+                                      dtype)
+    finally:
+        if threads is not None:
+            threads.close()
+            threads.join()
 
     # score marginals on the frames
     # if there is a pool, this will happen in parallel
@@ -196,72 +276,255 @@ def picksegment(start, stop, model, images,
 
     return marginals, path
 
-cdef double calcerroroverlap(int i, int j, annotations.Box box, double thres,
-                             int skip):
-    boxw = (box.xbr - box.xtl) // skip
-    boxh = (box.ybr - box.ytl) // skip
-
-    xdiff = min(i + boxw, box.xbr // skip) - max(i, box.xtl // skip) 
-    ydiff = min(j + boxh, box.ybr // skip) - max(j, box.ytl // skip) 
-
-    if xdiff <= 0 or ydiff <= 0:
-        error = 1.
-    else:
-        uni = boxw * boxh * 2 - xdiff * ydiff
-        error = xdiff * ydiff / float(uni)
-        if error >= thres:
-            error = 0.
-        else:
-            error = 1.
-    return error
+def segmentkey(box):
+    """
+    Returns a hashable key for a segment endpoint, a box or a frame.
+    """
+    try:
+        return (box.xtl, box.ytl, box.xbr, box.ybr, box.frame)
+    except AttributeError:
+        return (box,)
 
-def calcerror(pathdict, pointers, double erroroverlap, int skip, frames):
+class SegmentCache(object):
+    """
+    Keeps the state of pick() for one track between clicks.
+
+    The marginals and path of each segment are kept by its endpoints, and
+    the cost maps of up to capacity frames are kept by frame and box size.
+    A new click then only solves the two segments it splits, and the half
+    that starts at the same box is not scored again.
+
+    The model is learned again once retrain more clicks have been added, by
+    default every click. The segments that a click does not split keep the
+    marginals and errors of the model they were solved with, which is an
+    approximation: their next pick may differ from an uncached pick(). A
+    model learned from scratch drops the cost maps, so the split segments
+    are scored with the new model. If warm, the model is built incremental
+    and retraining only adds the new clicks to it, warm starting the SVM,
+    and the cost maps are kept as well, since the model moves little. If
+    exact, retraining drops everything instead, so every pick matches an
+    uncached pick() and only calls with the same givens are reused.
+    """
+    def __init__(self, retrain = 1, capacity = 1000, warm = False,
+                 exact = False):
+        self.retrain = retrain
+        self.capacity = capacity
+        self.warm = warm
+        self.exact = exact
+        self.model = None
+        self.trained = 0
+        self.segments = {}
+        self.costs = {}
+        self.order = []
+
+    def learn(self, images, givens, **kwargs):
+        """
+        Returns the model for the givens, learning it only when needed.
+        """
+        stale = (self.retrain is not None and
+                 len(givens) - self.trained >= self.retrain)
+        if self.model is None or stale:
+            if self.warm and self.model is not None:
+                self.model.update(images, givens)
+            else:
+                self.model = PathModel(images, givens,
+                                       incremental = self.warm, **kwargs)
+                self.costs = {}
+                self.order = []
+            self.trained = len(givens)
+            if self.exact:
+                self.segments = {}
+                self.costs = {}
+                self.order = []
+        return self.model
+
+    def keep(self, keys):
+        """
+        Forgets the segments that are not in keys, such as the ones a click
+        split.
+        """
+        self.segments = dict((x, self.segments[x]) for x in keys
+                             if x in self.segments)
+
+    def getcosts(self, frames, size):
+        """
+        Returns the cost maps held for frames scored with a box size.
+        """
+        return dict((x, self.costs[x, size]) for x in frames
+                    if (x, size) in self.costs)
+
+    def putcosts(self, costs, size):
+        """
+        Keeps cost maps scored with a box size, forgetting the oldest ones
+        beyond capacity.
+        """
+        for frame, cost in costs.items():
+            key = (frame, size)
+            if key in self.costs:
+                self.order.remove(key)
+            self.costs[key] = cost
+            self.order.append(key)
+        while len(self.order) > self.capacity:
+            del self.costs[self.order.pop(0)]
+
+def calcerroroverlap(shape, annotations.Box box, double thres, int skip):
+    """
+    Returns 0 for every cell whose box overlaps the given box by at least
+    thres and 1 for every other cell.
+    """
+    cdef int boxw = (box.xbr - box.xtl) // skip
+    cdef int boxh = (box.ybr - box.ytl) // skip
+
+    i = numpy.arange(shape[0])
+    j = numpy.arange(shape[1])
+    xdiff = (numpy.minimum(i + boxw, box.xbr // skip) -
+             numpy.maximum(i, box.xtl // skip))
+    ydiff = (numpy.minimum(j + boxh, box.ybr // skip) -
+             numpy.maximum(j, box.ytl // skip))
+
+    intersection = numpy.outer(xdiff, ydiff).astype(numpy.double)
+    with numpy.errstate(divide = "ignore", invalid = "ignore"):
+        overlap = intersection / (boxw * boxh * 2 - intersection)
+    overlap[xdiff <= 0, :] = 0
+    overlap[:, ydiff <= 0] = 0
+    return numpy.where(overlap >= thres, 0., 1.)
+
+def calcerror(pathdict, pointers, double erroroverlap, int skip, frames,
+              dtype = numpy.double):
     """
     Calculates the error going through a path at a certain point.
 
     We use dynamic programming to calculate error here in order to speed up
     the error calculation. We simply use the pairwise results from the
-    previous results.
+    previous results. The errors count frames, so they are exact in dtype
+    for any practical segment length.
     """
-    cdef int frame = frames[0]
-    cdef annotations.Box box = pathdict[frame]
-    cdef numpy.ndarray[numpy.double_t, ndim=2] previous, current, local
-    cdef numpy.ndarray[numpy.int_t, ndim=2] xpointer, ypointer
+    frame = frames[0]
     size = pointers[frames[-1]][1].shape
-    cdef int w = size[0], h = size[1]
-    cdef int xp, yp
-    cdef double message
 
     graph = {}
 
     # setup the base case
-    previous = numpy.zeros(size, dtype = numpy.double)
-    for i in range(w):
-        for j in range(h):
-            previous[i, j] = calcerroroverlap(i, j, box, erroroverlap, skip) 
+    previous = calcerroroverlap(size, pathdict[frame], erroroverlap, skip)
+    previous = previous.astype(dtype)
     graph[frame] = previous, previous
 
     # do the inductive steps
     for frame in frames[1:]:
-        current = numpy.zeros(size, dtype = numpy.double)
-        local = numpy.zeros(size, dtype = numpy.double)
-        box = pathdict[frame]
-        xpointer = pointers[frame][1]
-        ypointer = pointers[frame][2]
-
-        for i in range(w):
-            for j in range(h):
-                error = calcerroroverlap(i, j, box, erroroverlap, skip)
-                xp = xpointer[i, j]
-                yp = ypointer[i, j]
-                message = previous[xp, yp]
-                local[i, j] = error
-                current[i, j] = error + message
+        local = calcerroroverlap(size, pathdict[frame], erroroverlap, skip)
+        local = local.astype(dtype)
+        current = local + previous[pointers[frame][1], pointers[frame][2]]
         graph[frame] = current, local
         previous = current
     return graph
 
 def scoremarginals(workorder):
+    """
+    Scores how much annotating a frame is expected to reduce the error of
+    the path, from the forward and backward graphs and errors of the frame.
+    """
+    cdef double sigma
+    cdef int frame, radius
+    cdef annotations.Box start
+    (forw, backw, forwerr, backwerr, costs, sigma, dim, start, skip, radius, frame) = workorder
+
+    w, h = forw[1].shape
+
+    wr = dim[0] / (<double>start.width)
+    hr = dim[1] / (<double>start.height)
+    xs = (numpy.arange(w) * wr).astype(numpy.int)
+    ys = (numpy.arange(h) * hr).astype(numpy.int)
+
+    dtype = forw[0].dtype
+
+    # for numerical reasons, we want to subtract the most best score, which
+    # makes the largest log probability zero
+    gmargin = forw[0] + backw[0] - costs[numpy.ix_(xs, ys)].astype(dtype)
+    gmargin -= gmargin.min()
+
+    # compute error image, then take its minimum around every cell
+    errors = forwerr[0] + backwerr[0] - forwerr[1]
+    errors = slidingmin(errors, radius)
+    errors = slidingmin(errors.T, radius).T.astype(dtype)
+
+    # cells that cannot be reached have infinite cost and zero probability
+    gprob = numpy.exp(-gmargin / sigma)
+    greduct = gprob * errors
+    gerrors = errors
+
+    # accumulate in double precision whatever the dtype of the messages
+    score = greduct.sum(dtype = numpy.double)
+    normalizer = gprob.sum(dtype = numpy.double)
+
+    if debug:
+        gmargin = -gmargin
+        pylab.set_cmap("gray")
+        pylab.title("min = {0}, max = {1}".format(gmargin.min(), gmargin.max()))
+        pylab.imshow(gmargin.transpose())
+        pylab.savefig("tmp/margin{0}.png".format(frame))
+        pylab.clf()
+
+        pylab.set_cmap("gray")
+        gprob = gprob / normalizer
+        pylab.title("min = {0}, max = {1}".format(gprob.min(), gprob.max()))
+        pylab.imshow(gprob.transpose())
+        pylab.savefig("tmp/prob{0}.png".format(frame))
+        pylab.clf()
+
+        pylab.set_cmap("gray")
+        pylab.title("min = {0}, max = {1}".format(greduct.min(), greduct.max()))
+        pylab.imshow(greduct.transpose())
+        pylab.savefig("tmp/reduct{0}.png".format(frame))
+        pylab.clf()
+
+        pylab.set_cmap("gray")
+        pylab.title("min = {0}, max = {1}".format(gerrors.min(), gerrors.max()))
+        pylab.imshow(gerrors.transpose())
+        pylab.savefig("tmp/errors{0}.png".format(frame))
+        pylab.clf()
+
+    return score / normalizer, frame
+
+def slidingmin(values, int radius):
+    """
+    Returns the minimum of every cell and the cells from radius before it up
+    to radius after it along the second axis, never including the last cell
+    unless it is the cell itself. The window streams over each row with a
+    queue of candidates, so the cost does not depend on the radius.
+    """
+    cdef numpy.ndarray[numpy.double_t, ndim=2] source
+    source = numpy.ascontiguousarray(values, dtype = numpy.double)
+    cdef int w = source.shape[0], h = source.shape[1]
+    cdef numpy.ndarray[numpy.double_t, ndim=2] result = numpy.empty((w, h))
+    cdef numpy.ndarray[numpy.int_t, ndim=1] queue = numpy.empty(h + 1,
+                                                    dtype = numpy.int)
+    cdef int i, j, head, tail, stop
+    cdef double best
+
+    for i in range(w):
+        head = 0
+        tail = 0
+        stop = 0
+        for j in range(h):
+            while stop < h - 1 and stop < j + radius:
+                while tail > head and source[i, queue[tail-1]] >= source[i, stop]:
+                    tail = tail - 1
+                queue[tail] = stop
+                tail = tail + 1
+                stop = stop + 1
+            while head < tail and queue[head] < j - radius:
+                head = head + 1
+            best = source[i, j]
+            if head < tail and source[i, queue[head]] < best:
+                best = source[i, queue[head]]
+            result[i, j] = best
+    return result
+
+def scoremarginalsreference(workorder):
+    """
+    Scores the marginals of a frame one cell at a time. This is the original
+    loop, kept to check scoremarginals() against.
+    """
     cdef double sigma
     cdef int frame, radius
     cdef annotations.Box start
@@ -7,14 +7,150 @@ cimport cython
 
 log = logging.getLogger("vision.convolution")
 
-cpdef hogrgbmean(image, filtersize, hogfilter, rgbfilter, int hogbin = 8):
+cpdef hogrgbmean(image, filtersize, hogfilter, rgbfilter, int hogbin = 8,
+                 hogfeat = None, method = None, sumrgb = None):
     """
     Efficiently convolve a filter around an image for HOG and RGB means.
+
+    If hogfeat or sumrgb are given, they are used as the padded HOG features
+    and the color summed area tables of the image instead of computing them
+    again. method selects the HOG correlation engine, see hog().
+    """
+    h = hog(image, filtersize, hogfilter, hogbin, hogfeat, method) 
+    r = rgbmean(image, filtersize, rgbfilter, sumrgb)
+    return h + r
+
+cpdef hogrgbmeanbatch(image, filtersize, hogfilters, rgbfilters,
+                      int hogbin = 8, hogfeat = None, sumrgb = None):
+    """
+    Convolves many filters of the same size around an image for HOG and RGB
+    means at once.
+
+    hogfilters and rgbfilters are stacked along their first axis, one per
+    filter, and hogfeat and sumrgb are as in hogrgbmean(). Returns a
+    (filters, width, height) array of scores where each slice matches
+    hogrgbmean() for that filter.
     """
-    h = hog(image, filtersize, hogfilter, hogbin) 
-    r = rgbmean(image, filtersize, rgbfilter)
+    h = hogbatch(image, filtersize, hogfilters, hogbin, hogfeat)
+    r = rgbmeanbatch(image, filtersize, rgbfilters, sumrgb)
     return h + r
 
+cpdef hogbatch(image, filtersize, hogfilters, int hogbin = 8, hogfeat = None):
+    """
+    Convolves many HOG filters of the same size around an image.
+
+    The windows of the image are gathered once and every filter is scored
+    with a single matrix product. hogfilters should be a (filters,
+    height/hogbin, width/hogbin, 13) array. Returns a (filters, width,
+    height) array of scores laid out like hog().
+    """
+    cdef int width = image.size[0], height = image.size[1]
+    cdef int filterwidth = filtersize[0], filterheight = filtersize[1]
+    cdef int count = hogfilters.shape[0]
+    cdef int frows = hogfilters.shape[1], fcols = hogfilters.shape[2]
+
+    if hogfeat is None:
+        hogfeat = features.hogpad(features.hog(image, hogbin))
+    rows = hogfeat.shape[0] - frows + 1
+    cols = hogfeat.shape[1] - fcols + 1
+
+    windows = im2col(hogfeat, frows, fcols).reshape((rows * cols, -1))
+    cells = windows.dot(hogfilters.reshape((count, -1)).transpose())
+    cells = cells.transpose().reshape((count, rows, cols))
+
+    return np.array([expand(x, hogbin, width - filterwidth,
+                            height - filterheight) for x in cells])
+
+cpdef rgbmeanbatch(image, filtersize, rgbfilters, sumrgb = None):
+    """
+    Convolves many RGB mean filters of the same size around an image.
+
+    The windowed means of all 9 color moments are computed once from summed
+    area tables and then scored against every filter with a single matrix
+    product. rgbfilters should be a (filters, 9) array. Returns a (filters,
+    width, height) array of scores laid out like rgbmean().
+    """
+    if sumrgb is None:
+        sumrgb = rgbintegral(image)
+    means = rgbwindows(sumrgb, filtersize)
+    scores = means.reshape((-1, 9)).dot(np.asarray(rgbfilters).transpose())
+    scores = scores.reshape(means.shape[0:2] + (-1,))
+    return scores.transpose((2, 0, 1))
+
+cpdef rgbintegral(image):
+    """
+    Computes summed area tables of the 9 color moments used by rgbmean().
+
+    Returns a (width, height, 9) array where entry [i, j] holds the sum over
+    all pixels up to and including column i and row j.
+    """
+    cdef int width = image.size[0], height = image.size[1], i, j, k
+    cdef np.ndarray[np.uint8_t, ndim=3] data
+    data = np.ascontiguousarray(np.asarray(image, dtype = np.uint8))
+    cdef np.ndarray[np.double_t, ndim=3] sumrgb
+    sumrgb = np.empty((width, height, 9))
+    cdef double moment[9]
+    cdef double r, g, b
+
+    with nogil:
+        for i from 0 <= i < width:
+            for j from 0 <= j < height:
+                r = data[j, i, 0] / <double>(255)
+                g = data[j, i, 1] / <double>(255)
+                b = data[j, i, 2] / <double>(255)
+                moment[0] = r
+                moment[1] = g
+                moment[2] = b
+                moment[3] = r * r
+                moment[4] = r * g
+                moment[5] = r * b
+                moment[6] = g * g
+                moment[7] = g * b
+                moment[8] = b * b
+                for k from 0 <= k < 9:
+                    # lookup recursive sums
+                    if i > 0:
+                        moment[k] += sumrgb[i-1, j, k]
+                    if j > 0:
+                        moment[k] += sumrgb[i, j-1, k]
+                        if i > 0: # do not count twice
+                            moment[k] -= sumrgb[i-1, j-1, k]
+                    sumrgb[i, j, k] = moment[k]
+    return sumrgb
+
+cpdef rgbwindows(sumrgbin, filtersize):
+    """
+    Computes the mean color moments in every window of filtersize from the
+    summed area tables of rgbintegral(). Returns a (width - filterwidth,
+    height - filterheight, 9) array.
+    """
+    cdef int filterwidth = filtersize[0], filterheight = filtersize[1]
+    cdef np.ndarray[np.double_t, ndim=3] sumrgb = sumrgbin
+    cdef int width = sumrgb.shape[0], height = sumrgb.shape[1], i, j, k
+    cdef double area = filterwidth * filterheight
+    cdef np.ndarray[np.double_t, ndim=3] means
+    means = np.empty((max(width - filterwidth, 0),
+                      max(height - filterheight, 0), 9))
+
+    with nogil:
+        for i from 0 <= i < width - filterwidth:
+            for j from 0 <= j < height - filterheight:
+                for k from 0 <= k < 9:
+                    means[i, j, k] = (sumrgb[i, j, k] +
+                        sumrgb[i+filterwidth, j+filterheight, k] -
+                        sumrgb[i, j+filterheight, k] -
+                        sumrgb[i+filterwidth, j, k]) / area
+    return means
+
+cpdef expand(cells, int hogbin, int width, int height):
+    """
+    Expands scores indexed by (row, column) of a HOG cell into a (width,
+    height) map with one score per pixel of the cell.
+    """
+    cells = np.repeat(cells, hogbin, axis = 0)[:height]
+    cells = np.repeat(cells, hogbin, axis = 1)[:, :width]
+    return cells.transpose()
+
 cpdef sumprob(probmap):
     """
     Efficiently convolves a sum-flter around an image to sum probabilities.
@@ -24,20 +160,22 @@ cpdef sumprob(probmap):
     cdef np.ndarray[np.double_t, ndim=2] data = probmap
     cdef np.ndarray[np.double_t, ndim=2] sumarea = np.zeros((width, height))
     cdef double local = 0
-    for i from 0 <= i < width:
-        for j from 0 <= j < height:
-            local = data[i, j]
-            # lookup recursive scores
-            if i > 0:
-                local += sumarea[i-1, j]
-            if j > 0:
-                local += sumarea[i, j-1] 
-                if i > 0: # do not count twice
-                    local -= sumarea[i-1, j-1]
-            sumarea[i, j] = local
+    with nogil:
+        for i from 0 <= i < width:
+            for j from 0 <= j < height:
+                local = data[i, j]
+                # lookup recursive scores
+                if i > 0:
+                    local += sumarea[i-1, j]
+                if j > 0:
+                    local += sumarea[i, j-1] 
+                    if i > 0: # do not count twice
+                        local -= sumarea[i-1, j-1]
+                sumarea[i, j] = local
     return sumarea
 
-cpdef hog(image, filtersize, hogfilter, int hogbin = 8):
+cpdef hog(image, filtersize, hogfilter, int hogbin = 8, hogfeat = None,
+          method = None):
     """
     Efficiently convolves a filter around an image for HOG.
 
@@ -48,46 +186,124 @@ cpdef hog(image, filtersize, hogfilter, int hogbin = 8):
     - image should be an Python Image Library image.
     - filtersize should be a 2-tuple of (width,height) sizes for the template
       filter.
-    - hogfilter should be a (width/hogbin-2, height/hogbin-2, 13) numpy array
+    - hogfilter should be a (height/hogbin, width/hogbin, 13) numpy array
       of the learned HOG weights.
+    - hogfeat may be the padded HOG features of the image if they are already
+      available, such as from a feature pyramid.
+    - method selects the correlation engine, as in correlate(). "direct"
+      runs the original per pixel loop.
+
+    Every pixel inside a HOG cell reads the same features, so the filter is
+    only correlated once per cell and the scores are expanded to pixels.
+    """
+    if method == "direct":
+        return hogdirect(image, filtersize, hogfilter, hogbin, hogfeat)
+
+    cdef int width = image.size[0], height = image.size[1]
+    cdef int filterwidth = filtersize[0], filterheight = filtersize[1]
+
+    if hogfeat is None:
+        hogfeat = features.hogpad(features.hog(image, hogbin))
+    cells = correlate(hogfeat, hogfilter, method)
+    return expand(cells, hogbin, width - filterwidth, height - filterheight)
+
+cpdef correlate(hogfeat, hogfilter, method = None):
+    """
+    Correlates a HOG filter with HOG features over every valid cell offset.
+
+    Both arrays are indexed by (row, column, channel) and the result is
+    indexed by (row, column) of the top left cell.
+
+    - method "im2col" gathers every window into a matrix and scores them
+      with one matrix-vector product.
+    - method "fft" multiplies the spectra of each channel and transforms
+      back once, which is cheaper for large filters.
+    - method None picks between them based on the size of the filter.
+    """
+    cdef int rows = hogfeat.shape[0], cols = hogfeat.shape[1]
+    cdef int frows = hogfilter.shape[0], fcols = hogfilter.shape[1]
+    cdef int channels = hogfeat.shape[2]
+
+    if frows > rows or fcols > cols:
+        return np.zeros((max(rows - frows + 1, 0), max(cols - fcols + 1, 0)))
+
+    # the spectra cost about the same for any filter, so the matrix product
+    # only wins for filters of a handful of cells
+    if method is None:
+        if frows * fcols > 9:
+            method = "fft"
+        else:
+            method = "im2col"
+
+    if method == "im2col":
+        windows = im2col(hogfeat, frows, fcols)
+        windows = windows.reshape((rows - frows + 1, cols - fcols + 1, -1))
+        return windows.dot(hogfilter.ravel())
+    elif method == "fft":
+        spectrum = np.fft.rfft2(hogfeat, axes = (0, 1))
+        spectrum *= np.conj(np.fft.rfft2(hogfilter, s = (rows, cols),
+                                         axes = (0, 1)))
+        response = np.fft.irfft2(spectrum.sum(axis = 2), s = (rows, cols))
+        return response[:rows - frows + 1, :cols - fcols + 1]
+    raise ValueError("Unknown correlation method {0}".format(method))
+
+cpdef im2col(hogfeat, int frows, int fcols):
+    """
+    Returns a read only view of every (frows, fcols) window of the features,
+    indexed by (row, column, window row, window column, channel). Flattening
+    a window gives the same layout as a flattened HOG patch.
+    """
+    hogfeat = np.ascontiguousarray(hogfeat)
+    cdef int rows = hogfeat.shape[0], cols = hogfeat.shape[1]
+    strides = hogfeat.strides[0:2] + hogfeat.strides
+    shape = (rows - frows + 1, cols - fcols + 1, frows, fcols,
+             hogfeat.shape[2])
+    return np.lib.stride_tricks.as_strided(hogfeat, shape, strides)
+
+cpdef hogdirect(image, filtersize, hogfilter, int hogbin = 8,
+                hogfeat = None):
+    """
+    Convolves a filter around an image for HOG one pixel at a time. This is
+    the original implementation of hog(), kept for comparison.
     """
 
     # initialize some useful stuff
     cdef int width = image.size[0], height = image.size[1], i = 0, j = 0
     cdef int filterwidth = filtersize[0], filterheight = filtersize[1]
-    cdef np.ndarray[np.double_t, ndim=3] data
-    data = np.asarray(image, dtype=np.double)
 
     # efficiently precompute hog features
-    cdef np.ndarray[ndim=3, dtype=np.double_t] hogfeat
-    hogfeat = features.hog(image, hogbin)
-    hogfeat = features.hogpad(hogfeat)
+    cdef np.ndarray[ndim=3, dtype=np.double_t] hogfeatt
+    if hogfeat is None:
+        hogfeat = features.hogpad(features.hog(image, hogbin))
+    hogfeatt = hogfeat
     cdef np.ndarray[ndim=3, dtype=np.double_t] hogfiltert = hogfilter
 
     # convolve
     cdef int hfwidth = hogfilter.shape[0], hfheight = hogfilter.shape[1]
+    cdef int hfi, hfj, hfk
     cdef double hogscore, hogfeatvalue, hogfiltervalue
     cdef np.ndarray[ndim=2, dtype=np.double_t] output
     output = np.zeros((width - filterwidth,
                        height - filterheight))
 
-    for i from 0 <= i < width - filterwidth:
-        for j from 0 <= j < height - filterheight:
-            # compute hog score
-            hogscore = 0. 
-            for hfi from 0 <= hfi < hfwidth:
-                for hfj from 0 <= hfj < hfheight:
-                    for hfk from 0 <= hfk < 13:
-                        hogfeatvalue = hogfeat[j/hogbin+hfj, 
-                                               i/hogbin+hfi, hfk] 
-                        hogfiltervalue = hogfiltert[hfj, hfi, hfk]
-                        hogscore += hogfeatvalue * hogfiltervalue
-
-            # store final score
-            output[i,j] = hogscore 
+    with nogil:
+        for i from 0 <= i < width - filterwidth:
+            for j from 0 <= j < height - filterheight:
+                # compute hog score
+                hogscore = 0. 
+                for hfi from 0 <= hfi < hfwidth:
+                    for hfj from 0 <= hfj < hfheight:
+                        for hfk from 0 <= hfk < 13:
+                            hogfeatvalue = hogfeatt[j/hogbin+hfj, 
+                                                   i/hogbin+hfi, hfk] 
+                            hogfiltervalue = hogfiltert[hfj, hfi, hfk]
+                            hogscore += hogfeatvalue * hogfiltervalue
+
+                # store final score
+                output[i,j] = hogscore 
     return output
 
-cpdef rgbhist(image, filtersize, rgbfilter, int rgbbin = 8):
+cpdef rgbhist(image, filtersize, rgbfilter, int rgbbin = 8, bins = None):
     """
     Efficiently convolves a filter around an image for RGB filters.
 
@@ -99,52 +315,29 @@ cpdef rgbhist(image, filtersize, rgbfilter, int rgbbin = 8):
       filter.
     - rgbfilter should be a rgbin^3 length matrix of the learned RGB histogram
       weights.
-    """
-
-    # initialize some useful stuff
-    cdef int width = image.size[0], height = image.size[1], i = 0, j = 0
-    cdef int filterwidth = filtersize[0], filterheight = filtersize[1]
-    cdef np.ndarray[np.double_t, ndim=3] data
-    data = np.asarray(image, dtype=np.double)
-
-    # efficiently precompute integral rgb score image
-    cdef np.ndarray[np.double_t, ndim=2] sumrgb = np.zeros((width, height))
-    cdef np.ndarray[ndim=1, dtype=np.double_t] rgbfiltert = rgbfilter
-    cdef double localrgbscore
-    for i from 0 <= i < width:
-        for j from 0 <= j < height:
-            # we cannot manipulate the algebra below because we are taking
-            # advantage of rounding
-            localrgbbin  = (<int>data[j,i,0]) / (256/rgbbin)
-            localrgbbin += (<int>data[j,i,1]) / (256/rgbbin) * rgbbin
-            localrgbbin += (<int>data[j,i,2]) / (256/rgbbin) * rgbbin * rgbbin
-            localrgbscore = rgbfiltert[localrgbbin]
-            # lookup recursive scores
-            if i > 0:
-                localrgbscore += sumrgb[i-1, j]
-            if j > 0:
-                localrgbscore += sumrgb[i, j-1] 
-                if i > 0: # do not count twice
-                    localrgbscore -= sumrgb[i-1, j-1]
-            sumrgb[i, j] = localrgbscore
-
-    # convolve
-    cdef double rgbscore
-    cdef np.ndarray[ndim=2, dtype=np.double_t] output
-    output = np.zeros((width - filterwidth, height - filterheight))
+    - bins may be the rgbbins() of the image if they are already available.
 
-    for i from 0 <= i < width - filterwidth:
-        for j from 0 <= j < height - filterheight:
-            # compute rgb score using summed area tables
-            rgbscore  = sumrgb[i+filterwidth, j+filterheight] + sumrgb[i, j]
-            rgbscore -= sumrgb[i, j+filterheight] + sumrgb[i+filterwidth, j]
-            rgbscore  = rgbscore / (filterwidth * filterheight)
+    A table per histogram bin would need rgbbin^3 maps, so the bins of the
+    image are looked up once and only the filter response is summed.
+    """
+    if bins is None:
+        bins = rgbbins(image, rgbbin)
+    return window(sumprob(np.asarray(rgbfilter, dtype = np.double)[bins]),
+                  filtersize)
 
-            # store final score
-            output[i,j] = rgbscore
-    return output
+cpdef rgbbins(image, int rgbbin = 8):
+    """
+    Computes the RGB histogram bin of every pixel as a (width, height) array.
+    """
+    data = np.asarray(image, dtype = np.int).transpose((1, 0, 2))
+    # we cannot manipulate the algebra below because we are taking
+    # advantage of rounding
+    bins  = data[:, :, 0] / (256/rgbbin)
+    bins += data[:, :, 1] / (256/rgbbin) * rgbbin
+    bins += data[:, :, 2] / (256/rgbbin) * rgbbin * rgbbin
+    return bins
 
-cpdef rgbmean(image, filtersize, rgbfilter):
+cpdef rgbmean(image, filtersize, rgbfilter, sumrgb = None):
     """
     Efficiently convolves a filter around an image for RGB filters.
 
@@ -154,59 +347,67 @@ cpdef rgbmean(image, filtersize, rgbfilter):
     - image should be an Python Image Library image.
     - filtersize should be a 2-tuple of (width,height) sizes for the template
       filter.
+    - sumrgb may be the rgbintegral() of the image if it is already
+      available, such as from a feature pyramid.
+
+    The score is linear in the color moments, so a single summed area table
+    of the filter response scores every window in constant time. Shared
+    tables of the moments are weighted by the filter instead.
     """
+    if sumrgb is None:
+        summed = rgbresponse(image, rgbfilter)
+    else:
+        summed = sumrgb.dot(np.asarray(rgbfilter, dtype = np.double))
+    return window(summed, filtersize)
 
-    # initialize some useful stuff
+cpdef rgbresponse(image, rgbfilter):
+    """
+    Computes the summed area table of the response of an RGB mean filter,
+    for when the tables of the moments are not shared.
+    """
     cdef int width = image.size[0], height = image.size[1], i = 0, j = 0
-    cdef int filterwidth = filtersize[0], filterheight = filtersize[1]
-    cdef np.ndarray[np.double_t, ndim=3] data
-    data = np.asarray(image, dtype=np.double)
+    cdef np.ndarray[np.uint8_t, ndim=3] data
+    data = np.ascontiguousarray(np.asarray(image, dtype = np.uint8))
 
-    # efficiently precompute integral rgb score image
     cdef np.ndarray[np.double_t, ndim=2] sumrgb = np.zeros((width, height))
-    cdef np.ndarray[ndim=1, dtype=np.double_t] rgbfiltert = rgbfilter
+    cdef np.ndarray[ndim=1, dtype=np.double_t] rgbfiltert
+    rgbfiltert = np.asarray(rgbfilter, dtype = np.double)
     cdef double localrgbscore, r, g, b
-    for i from 0 <= i < width:
-        for j from 0 <= j < height:
-            r = data[j, i, 0] / <double>(255)
-            g = data[j, i, 1] / <double>(255)
-            b = data[j, i, 2] / <double>(255)
-            localrgbscore = 0
-            localrgbscore += r * rgbfiltert[0]
-            localrgbscore += g * rgbfiltert[1]
-            localrgbscore += b * rgbfiltert[2]
-            localrgbscore += r * r * rgbfiltert[3]
-            localrgbscore += r * g * rgbfiltert[4]
-            localrgbscore += r * b * rgbfiltert[5]
-            localrgbscore += g * g * rgbfiltert[6]
-            localrgbscore += g * b * rgbfiltert[7]
-            localrgbscore += b * b * rgbfiltert[8]
-
-            # lookup recursive scores
-            if i > 0:
-                localrgbscore += sumrgb[i-1, j]
-            if j > 0:
-                localrgbscore += sumrgb[i, j-1] 
-                if i > 0: # do not count twice
-                    localrgbscore -= sumrgb[i-1, j-1]
-            sumrgb[i, j] = localrgbscore
+    with nogil:
+        for i from 0 <= i < width:
+            for j from 0 <= j < height:
+                r = data[j, i, 0] / <double>(255)
+                g = data[j, i, 1] / <double>(255)
+                b = data[j, i, 2] / <double>(255)
+                localrgbscore = 0
+                localrgbscore += r * rgbfiltert[0]
+                localrgbscore += g * rgbfiltert[1]
+                localrgbscore += b * rgbfiltert[2]
+                localrgbscore += r * r * rgbfiltert[3]
+                localrgbscore += r * g * rgbfiltert[4]
+                localrgbscore += r * b * rgbfiltert[5]
+                localrgbscore += g * g * rgbfiltert[6]
+                localrgbscore += g * b * rgbfiltert[7]
+                localrgbscore += b * b * rgbfiltert[8]
 
-    # convolve
-    cdef double rgbscore
-    cdef np.ndarray[ndim=2, dtype=np.double_t] output
-    output = np.zeros((width - filterwidth,
-                       height - filterheight))
-
-    for i from 0 <= i < width - filterwidth:
-        for j from 0 <= j < height - filterheight:
-            # compute rgb score using summed area tables
-            rgbscore  = sumrgb[i, j]
-            rgbscore += sumrgb[i+filterwidth, j+filterheight]
-            rgbscore -= sumrgb[i, j+filterheight]
-            rgbscore -= sumrgb[i+filterwidth, j]
-
-            rgbscore = rgbscore / (filterwidth * filterheight)
+                # lookup recursive scores
+                if i > 0:
+                    localrgbscore += sumrgb[i-1, j]
+                if j > 0:
+                    localrgbscore += sumrgb[i, j-1] 
+                    if i > 0: # do not count twice
+                        localrgbscore -= sumrgb[i-1, j-1]
+                sumrgb[i, j] = localrgbscore
+    return sumrgb
 
-            # store final score
-            output[i,j] = rgbscore
-    return output
+cpdef window(summed, filtersize):
+    """
+    Computes the mean in every window of filtersize from a (width, height)
+    summed area table. Returns a (width - filterwidth, height - filterheight)
+    array.
+    """
+    cdef int filterwidth = filtersize[0], filterheight = filtersize[1]
+    means  = summed[filterwidth:, filterheight:] + summed[:-filterwidth, :-filterheight]
+    means -= summed[:-filterwidth, filterheight:] + summed[filterwidth:, :-filterheight]
+    means /= filterwidth * filterheight
+    return means
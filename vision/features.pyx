@@ -1,18 +1,259 @@
 import numpy as np
 import Image
+import threading
 cimport numpy as np
 cimport cython
 
 cdef extern from "math.h":
-    double sqrt(double i)
-    double fabs(double i)
-    double floor(double i)
+    double sqrt(double i) nogil
+    double fabs(double i) nogil
+    double floor(double i) nogil
 
-cpdef hog(im, int sbin = 8): 
+cdef double hoguu[9]
+cdef double hogvv[9]
+hoguu[:] = [1.0000, 0.9397, 0.7660, 0.500, 0.1736,
+            -0.1736, -0.5000, -0.7660, -0.9397]
+hogvv[:] = [0.0000, 0.3420, 0.6428, 0.8660, 0.9848,
+            0.9848, 0.8660, 0.6428, 0.3420]
+
+# a featurestore.FeatureStore that hog() consults, see featurestore.install()
+store = None
+
+cpdef hog(im, int sbin = 8, int threads = 1, reference = False, cache = True):
+    """
+    Computes a histogram of oriented gradient features.
+
+    The work is split into three passes that each operate on independent
+    strips of rows: snapping every pixel to its strongest orientation,
+    gathering the votes of each cell, and normalizing the blocks. If threads
+    is more than 1, each pass is divided into row bands that run concurrently
+    without the GIL.
+
+    Every cell adds its votes in the same order as hogreference(), so the
+    output is bit for bit identical. Set reference to True to run the
+    reference implementation instead.
+
+    If a feature store is installed, the features are read from it when
+    present and written to it otherwise, unless cache is False.
+    """
+    if cache and store is not None:
+        return store.hog(im, sbin, threads = threads, reference = reference)
+    if reference:
+        return hogreference(im, sbin)
+
+    width, height = im.size
+    cdef int blocks0 = height / sbin, blocks1 = width / sbin
+    cdef int out0 = blocks0 - 2, out1 = blocks1 - 2
+    cdef int visible0 = blocks0 * sbin, visible1 = blocks1 * sbin
+    cdef int x, ixp
+    cdef double xp
+
+    data = np.ascontiguousarray(np.asarray(im, dtype=np.double))
+    mag = np.zeros((visible0, visible1), dtype=np.double)
+    ori = np.zeros((visible0, visible1), dtype=np.int32)
+    hist = np.zeros(blocks0 * blocks1 * 9, dtype=np.double)
+    norm = np.zeros(blocks0 * blocks1, dtype=np.double)
+    feat = np.zeros((max(out0, 0), max(out1, 0), 9 + 4), dtype=np.double)
+    if out0 <= 0 or out1 <= 0:
+        return feat
+
+    # interpolation weights only depend on the row or column, and the range
+    # of pixels that vote into a cell is contiguous because floor() is
+    # monotonic, so both can be tabulated once
+    cdef int visible = max(visible0, visible1)
+    cdef np.ndarray[np.int32_t, ndim=1] index = np.zeros(visible, np.int32)
+    cdef np.ndarray[np.double_t, ndim=1] weight = np.zeros(visible)
+    cdef np.ndarray[np.int32_t, ndim=1] first, last
+    first = np.zeros(max(blocks0, blocks1), np.int32)
+    last = np.zeros(max(blocks0, blocks1), np.int32)
+    for x from 0 <= x < visible:
+        xp = (<double>(x) + 0.5) / <double>(sbin) - 0.5
+        ixp = <int>floor(xp)
+        index[x] = ixp
+        weight[x] = xp - ixp
+    for ixp from 0 <= ixp < max(blocks0, blocks1):
+        first[ixp] = visible
+        last[ixp] = 0
+    for x from 1 <= x < visible - 1:
+        for ixp from index[x] <= ixp < index[x] + 2:
+            if 0 <= ixp < max(blocks0, blocks1):
+                if x < first[ixp]:
+                    first[ixp] = x
+                if x + 1 > last[ixp]:
+                    last[ixp] = x + 1
+
+    _hogbands(_hogorientations, threads, 1, visible0 - 1,
+              (data, mag, ori, visible1))
+    _hogbands(_hogcells, threads, 0, blocks0,
+              (mag, ori, hist, norm, index, weight, first, last,
+               blocks0, blocks1, visible0, visible1))
+    _hogbands(_hognormalize, threads, 0, out0,
+              (hist, norm, feat, blocks0, blocks1))
+    return feat
+
+def _hogbands(worker, int threads, int start, int stop, args):
+    """
+    Runs a worker over the rows [start, stop), splitting them into at most
+    threads contiguous bands that are processed concurrently.
+    """
+    cdef int n = stop - start
+    if threads <= 1 or n < 2:
+        worker(start, stop, *args)
+        return
+    threads = min(threads, n)
+    bands = [threading.Thread(target = worker,
+                              args = (start + n * i / threads,
+                                      start + n * (i + 1) / threads) + args)
+             for i in range(threads)]
+    for band in bands:
+        band.start()
+    for band in bands:
+        band.join()
+
+def _hogorientations(int start, int stop, double[:, :, ::1] data,
+                     double[:, ::1] mag, int[:, ::1] ori, int visible1):
+    """
+    Snaps pixels in rows [start, stop) to one of 9 orientations.
+    """
+    cdef double dy, dx, v, dy2, dx2, v2, dy3, dx3, v3
+    cdef double best_dot, dot
+    cdef int x, y, o, best_o
+    with nogil:
+        for y from start <= y < stop:
+            for x from 1 <= x < visible1 - 1:
+                dy = data[y + 1, x, 0] - data[y - 1, x, 0]
+                dx = data[y, x + 1, 0] - data[y, x - 1, 0]
+                v = dx * dx + dy * dy
+
+                dy2 = data[y + 1, x, 1] - data[y - 1, x, 1]
+                dx2 = data[y, x + 1, 1] - data[y, x - 1, 1]
+                v2 = dx2 * dx2 + dy2 * dy2
+
+                dy3 = data[y + 1, x, 2] - data[y - 1, x, 2]
+                dx3 = data[y, x + 1, 2] - data[y, x - 1, 2]
+                v3 = dx3 * dx3 + dy3 * dy3
+
+                if v2 > v: # pick channel with strongest gradient
+                    v = v2
+                    dx = dx2
+                    dy = dy2
+                if v3 > v:
+                    v = v3
+                    dx = dx3
+                    dy = dy3
+
+                best_dot = 0.
+                best_o = 0
+                for o from 0 <= o < 9:
+                    dot = fabs(hoguu[o] * dx + hogvv[o] * dy)
+                    if dot > best_dot:
+                        best_dot = dot
+                        best_o = o
+
+                mag[y, x] = sqrt(v)
+                ori[y, x] = best_o
+
+def _hogcells(int start, int stop, double[:, ::1] mag, int[:, ::1] ori,
+              double[::1] hist, double[::1] norm,
+              int[::1] index, double[::1] weight,
+              int[::1] first, int[::1] last,
+              int blocks0, int blocks1, int visible0, int visible1):
+    """
+    Accumulates the histograms and energies for cell rows [start, stop).
+    """
+    cdef double acc[9]
+    cdef double vx, vy, energy
+    cdef int cx, cy, x, y, o
+    cdef int ystart, ystop, xstart, xstop
+    with nogil:
+        for cy from start <= cy < stop:
+            ystart = first[cy]
+            ystop = last[cy]
+            if ystop > visible0 - 1:
+                ystop = visible0 - 1
+            for cx from 0 <= cx < blocks1:
+                xstart = first[cx]
+                xstop = last[cx]
+                if xstop > visible1 - 1:
+                    xstop = visible1 - 1
+                for o from 0 <= o < 9:
+                    acc[o] = 0
+                # visit the pixels in the same order as the reference
+                for x from xstart <= x < xstop:
+                    if index[x] == cx:
+                        vx = 1.0 - weight[x]
+                    else:
+                        vx = weight[x]
+                    for y from ystart <= y < ystop:
+                        if index[y] == cy:
+                            vy = 1.0 - weight[y]
+                        else:
+                            vy = weight[y]
+                        acc[ori[y, x]] += vx * vy * mag[y, x]
+                energy = 0
+                for o from 0 <= o < 9:
+                    hist[cx * blocks0 + cy + o * blocks0 * blocks1] = acc[o]
+                    energy += acc[o] * acc[o]
+                norm[cx * blocks0 + cy] = energy
+
+def _hognormalize(int start, int stop, double[::1] hist, double[::1] norm,
+                  double[:, :, ::1] feat, int blocks0, int blocks1):
+    """
+    Normalizes the blocks for output rows [start, stop).
+    """
+    cdef double n1, n2, n3, n4, t1, t2, t3, t4, h1, h2, h3, h4
+    cdef double eps = 0.0001 # to avoid division by 0
+    cdef int x, y, o, p, srcptr
+    cdef int out1 = feat.shape[1]
+    with nogil:
+        for x from 0 <= x < out1:
+            for y from start <= y < stop:
+                p = (x+1) * blocks0 + y + 1
+                n1 = 1.0 / sqrt(norm[p] + norm[p+1] + norm[p+blocks0] + norm[p+blocks0+1] + eps)
+                p = (x+1) * blocks0 + y 
+                n2 = 1.0 / sqrt(norm[p] + norm[p+1] + norm[p+blocks0] + norm[p+blocks0+1] + eps)
+                p = x * blocks0 + y + 1
+                n3 = 1.0 / sqrt(norm[p] + norm[p+1] + norm[p+blocks0] + norm[p+blocks0+1] + eps)
+                p = x * blocks0 + y
+                n4 = 1.0 / sqrt(norm[p] + norm[p+1] + norm[p+blocks0] + norm[p+blocks0+1] + eps)
+
+                t1 = 0
+                t2 = 0
+                t3 = 0
+                t4 = 0
+
+                srcptr = (x+1) * blocks0 + y + 1
+                for o from 0 <= o < 9:
+                    h1 = hist[srcptr] * n1
+                    h2 = hist[srcptr] * n2
+                    h3 = hist[srcptr] * n3
+                    h4 = hist[srcptr] * n4
+                    if h1 > 0.2:
+                        h1 = 0.2
+                    if h2 > 0.2:
+                        h2 = 0.2
+                    if h3 > 0.2:
+                        h3 = 0.2
+                    if h4 > 0.2:
+                        h4 = 0.2
+                    feat[y, x, o] = 0.5 * (h1 + h2 + h3 + h4)
+                    t1 += h1
+                    t2 += h2
+                    t3 += h3
+                    t4 += h4
+                    srcptr += blocks0 * blocks1
+
+                feat[y, x, 9] = 0.2357 * t1
+                feat[y, x, 10] = 0.2357 * t2
+                feat[y, x, 11] = 0.2357 * t3
+                feat[y, x, 12] = 0.2357 * t4
+
+cpdef hogreference(im, int sbin = 8): 
     """
     Computes a histogram of oriented gradient features.
 
-    Adopted from Pedro Felzenszwalb's features.cc
+    Adopted from Pedro Felzenszwalb's features.cc. This is the reference
+    implementation that hog() must match; it is kept for comparison.
     """
     cdef np.ndarray[np.double_t, ndim=3] data, feat
     cdef np.ndarray[np.double_t, ndim=1] hist, norm
@@ -178,14 +419,9 @@ cpdef hog(im, int sbin = 8):
 
 cpdef hogpad(np.ndarray[np.double_t, ndim=3] hog):
     cdef np.ndarray[np.double_t, ndim=3] out
-    cdef int i, j, k
     cdef int w = hog.shape[0], h = hog.shape[1], z = hog.shape[2]
     out = np.zeros((w + 2, h + 2, z))
-
-    for i in range(w):
-        for j in range(h):
-            for k in range(z):
-                out[i+1, j+1, k] = hog[i, j, k]
+    out[1:w+1, 1:h+1, :] = hog
     return out
 
 cpdef rgbhist(im, int binsize = 8):
@@ -0,0 +1,175 @@
+"""
+A persistent cache of HOG features on disk, so reports that score the same
+videos again skip feature extraction.
+
+>>> store = FeatureStore("/scratch/features", video = "VIRAT_S_040104")
+>>> install(store)
+>>> path = dp.fill(givens, video) # features.hog now consults the store
+"""
+
+import features
+import numpy
+import hashlib
+import logging
+import os
+import random
+
+logger = logging.getLogger("vision.featurestore")
+
+class FeatureStore(object):
+    """
+    Stores HOG features as memory mapped .npy shards under a directory per
+    video.
+
+    Shards are addressed by a hash of the image contents, its size and the
+    sbin, so a frame resized to another scale or scored with another sbin
+    or model dim gets its own shard and stale features are never served.
+    The store holds at most capacity bytes and evicts the least recently
+    used shards first. Shards written by a different layout version are
+    discarded when the store is opened.
+    """
+
+    version = 1
+
+    def __init__(self, root, video = "default", capacity = 2**30):
+        self.root = os.path.join(root, video)
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(self.root)
+        except OSError:
+            pass
+        self.checkversion()
+        self.usage = sum(os.path.getsize(x) for x in self.shards())
+
+    def checkversion(self):
+        """
+        Clears the store if it was written by a different layout version.
+        """
+        marker = os.path.join(self.root, "VERSION")
+        try:
+            version = int(open(marker).read())
+        except (IOError, ValueError):
+            version = None
+        if version != self.version:
+            if version is not None:
+                logger.info("Feature store {0} has version {1}, but need {2}, "
+                            "so clearing".format(self.root, version,
+                                                 self.version))
+            self.clear()
+            with open(marker, "w") as f:
+                f.write(str(self.version))
+
+    def key(self, image, sbin):
+        """
+        Returns the content address for the features of an image.
+        """
+        try:
+            data = image.tobytes()
+        except AttributeError: # older PIL
+            data = image.tostring()
+        digest = hashlib.sha1(data)
+        digest.update("{0} {1} {2}".format(image.mode, image.size, sbin))
+        return "{0}-{1}".format(digest.hexdigest(), sbin)
+
+    def path(self, key):
+        return os.path.join(self.root, "{0}.npy".format(key))
+
+    def shards(self):
+        return [os.path.join(self.root, x) for x in os.listdir(self.root)
+                if x.endswith(".npy")]
+
+    def get(self, key):
+        """
+        Returns the stored features for a key or None if they are missing.
+        The features are memory mapped copy on write, so they can be used
+        like a normal array.
+        """
+        path = self.path(key)
+        try:
+            feat = numpy.load(path, mmap_mode = "c")
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return feat
+
+    def put(self, key, feat):
+        """
+        Writes features for a key and evicts old shards to stay in capacity.
+        Overwriting a key replaces the size of its old shard in the usage.
+        """
+        path = self.path(key)
+        temporary = "{0}.{1}.tmp".format(path, random.randint(0, 2**30))
+        with open(temporary, "wb") as f:
+            numpy.save(f, numpy.ascontiguousarray(feat))
+        try:
+            previous = os.path.getsize(path)
+        except OSError:
+            previous = 0
+        os.rename(temporary, path)
+        self.usage += os.path.getsize(path) - previous
+        if self.usage > self.capacity:
+            self.evict()
+
+    def hog(self, image, sbin = 8, **kwargs):
+        """
+        Returns the HOG features of an image, computing and storing them
+        only if they are not already in the store.
+        """
+        key = self.key(image, sbin)
+        feat = self.get(key)
+        if feat is None:
+            feat = features.hog(image, sbin, cache = False, **kwargs)
+            self.put(key, feat)
+        return feat
+
+    def evict(self):
+        """
+        Removes the least recently used shards until the store is in capacity.
+        """
+        shards = []
+        for path in self.shards():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            shards.append((stat.st_mtime, stat.st_size, path))
+        shards.sort()
+        self.usage = sum(x[1] for x in shards)
+        for _, size, path in shards:
+            if self.usage <= self.capacity:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.usage -= size
+        logger.debug("Feature store {0} at {1} bytes".format(self.root,
+                                                             self.usage))
+
+    def clear(self):
+        """
+        Removes every shard in the store.
+        """
+        for path in self.shards():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.usage = 0
+
+    def __len__(self):
+        return len(self.shards())
+
+def install(store):
+    """
+    Makes features.hog consult a feature store for every image, or stop
+    consulting one if store is None.
+    """
+    features.store = store
@@ -1,8 +1,18 @@
 import os
+import re
+import itertools
 import shutil
 import random
+import struct
+import subprocess
+import threading
+import logging
+import numpy
+from collections import OrderedDict
 from PIL import Image
 
+logger = logging.getLogger("vision.ffmpeg")
+
 def which(program):
     """Function to check for presence of executable/installed program
        Used for checking presense of ffmpeg/avconv"""
@@ -23,6 +33,49 @@ def which(program):
 
     return None
 
+def decoder():
+    """
+    Returns the name of the program used to decode video.
+    """
+    if which("ffmpeg") is not None:
+        return "ffmpeg"
+    return "avconv"
+
+def probe(path):
+    """
+    Returns the size and frame rate of the first video stream of a file, as
+    reported by the decoder. The frame rate is None if it is not reported.
+    """
+    process = subprocess.Popen([decoder(), "-i", path],
+                               stdout = subprocess.PIPE,
+                               stderr = subprocess.PIPE)
+    _, info = process.communicate()
+    for line in info.splitlines():
+        if "Video:" not in line:
+            continue
+        size = re.search(r"[ ,](\d{2,5})x(\d{2,5})[ ,\[]", line)
+        if not size:
+            continue
+        fps = re.search(r"([\d.]+) (?:fps|tbr)", line)
+        fps = float(fps.group(1)) if fps else None
+        return (int(size.group(1)), int(size.group(2))), fps
+    raise IOError("Cannot find a video stream in {0}".format(path))
+
+def duration(path):
+    """
+    Returns the duration of a video in seconds, as reported by the decoder,
+    or None if it is not reported.
+    """
+    process = subprocess.Popen([decoder(), "-i", path],
+                               stdout = subprocess.PIPE,
+                               stderr = subprocess.PIPE)
+    _, info = process.communicate()
+    match = re.search(r"Duration: (\d+):(\d+):([\d.]+)", info)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
 class extract(object):
     def __init__(self, path, fps = None, size = None):
         self.key = int(random.random() * 1000000000)
@@ -65,3 +118,315 @@ class extract(object):
     def __iter__(self):
         for i in range(len(self)):
             yield self[i]
+
+class framestore(object):
+    """
+    Frames of a video stored decoded in a single memory mapped file, so
+    reading a frame again costs no decode.
+
+    The file starts with a small header holding the number of frames, their
+    size and the frame rate, followed by the frames as one uint8 array of
+    shape (frames, height, width, 3). Indexing returns a PIL image, copied
+    from the map without decoding, and view() returns the frame as a numpy
+    view of the map without any copy.
+
+    >>> store = framestore.write(frameiterator("/scratch/frames/"), "v.raw")
+    >>> store = framestore("v.raw")
+    """
+
+    magic = "PYVF"
+    header = struct.Struct("<4sIIIId")
+    offset = 64
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            fields = self.header.unpack(f.read(self.header.size))
+        magic, version, length, width, height, fps = fields
+        if magic != self.magic or version != 1:
+            raise IOError("{0} is not a frame store".format(path))
+        self.size = (width, height)
+        self.fps = fps or None
+        self.length = length
+        if length:
+            self.data = numpy.memmap(path, dtype = numpy.uint8, mode = "r",
+                                     offset = self.offset,
+                                     shape = (length, height, width, 3))
+        else:
+            self.data = numpy.zeros((0, height, width, 3), numpy.uint8)
+
+    @classmethod
+    def write(cls, frames, path, fps = None):
+        """
+        Writes an iterable of images, all of the same size, into a new frame
+        store and returns it.
+        """
+        frames = iter(frames)
+        try:
+            first = next(frames).convert("RGB")
+        except StopIteration:
+            raise ValueError("There are no frames to write")
+        frames = itertools.chain([first], (x.convert("RGB") for x in frames))
+        return cls.writeraw((numpy.asarray(x).tostring() for x in frames),
+                            first.size, path, fps)
+
+    @classmethod
+    def writeraw(cls, chunks, size, path, fps = None, check = None):
+        """
+        Writes raw RGB frames into a new frame store and returns it. chunks
+        is an iterable of byte strings, each holding one frame of size.
+
+        If check is given, it is called with the number of frames written
+        before the store is moved to path, and may raise to abandon it.
+        Nothing is left at path if writing fails.
+        """
+        temporary = "{0}.{1}.tmp".format(path, os.getpid())
+        length = 0
+        try:
+            with open(temporary, "wb") as f:
+                f.write("\0" * cls.offset)
+                for chunk in chunks:
+                    f.write(chunk)
+                    length += 1
+                f.seek(0)
+                f.write(cls.header.pack(cls.magic, 1, length, size[0],
+                                        size[1], fps or 0))
+            if check is not None:
+                check(length)
+            os.rename(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        return cls(path)
+
+    def view(self, k):
+        """
+        Returns a frame as a read only (height, width, 3) view of the map.
+        """
+        return self.data[k]
+
+    def __getitem__(self, k):
+        if k < 0 or k >= self.length:
+            raise IndexError("Frame {0} is not in the store".format(k))
+        return Image.fromarray(numpy.array(self.data[k]))
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+class mmapextract(framestore):
+    """
+    Extracts a video into a memory mapped frame store instead of JPEGs. If
+    no output path is given, the store is temporary and removed with this
+    object; otherwise an existing store at output is reused.
+    """
+    def __init__(self, path, fps = None, size = None, output = None):
+        self.temporary = output is None
+        if output is None:
+            key = int(random.random() * 1000000000)
+            output = "/tmp/pyvision-ffmpeg-{0}.raw".format(key)
+        self.output = output
+
+        if not os.path.exists(output):
+            rate = fps
+            if size is None or fps is None:
+                videosize, videorate = probe(path)
+                size = size or videosize
+                rate = fps or videorate
+            w, h = int(size[0]), int(size[1])
+
+            cmd = [decoder(), "-i", path]
+            if fps:
+                cmd.extend(["-r", str(int(fps))])
+            cmd.extend(["-s", "{0}x{1}".format(w, h),
+                        "-f", "rawvideo", "-pix_fmt", "rgb24", "-"])
+            devnull = open(os.devnull, "w")
+            process = subprocess.Popen(cmd, stdout = subprocess.PIPE,
+                                       stderr = devnull)
+
+            def check(length):
+                process.stdout.close()
+                code = process.wait()
+                if code != 0 or length == 0:
+                    raise IOError("Decoding {0} failed with status {1} after "
+                                  "{2} frames".format(path, code, length))
+
+            try:
+                framestore.writeraw(readframes(process.stdout, w * h * 3),
+                                    (w, h), output, rate, check)
+            finally:
+                process.stdout.close()
+                process.wait()
+                devnull.close()
+
+        framestore.__init__(self, output)
+
+    def __del__(self):
+        if self.temporary and os.path.exists(self.output):
+            os.remove(self.output)
+
+def readframes(stream, framesize):
+    """
+    Yields whole frames of framesize bytes from a stream until it ends.
+    """
+    while True:
+        chunk = stream.read(framesize)
+        if len(chunk) < framesize:
+            return
+        yield chunk
+
+class pipe(object):
+    """
+    Decodes a video straight from the decoder through a pipe, as raw RGB
+    frames read into numpy buffers, so no files are written and the first
+    frame is available as soon as it is decoded. Frames are scaled to size
+    and resampled to fps by the decoder.
+
+    Reading frames in order keeps the pipe open. A frame behind the last
+    few decoded ones, or far ahead of the pipe, restarts the decoder with
+    a seek to that frame. Indexing returns a PIL image and view() the numpy
+    buffer of the frame.
+
+    >>> video = pipe("/scratch/video.mp4", size = (640, 360))
+    >>> dp.track(start, stop, model, video)
+    """
+    def __init__(self, path, fps = None, size = None, history = 30,
+                 seekahead = 50):
+        self.path = path
+        self.length = None
+        self.reset()
+        videosize, videorate = probe(path)
+        self.size = tuple(int(x) for x in (size or videosize))
+        self.fps = fps
+        self.rate = float(fps or videorate or 0)
+        if not self.rate:
+            logger.warning("Frame rate of {0} is unknown, seeking as if it "
+                           "were 25 fps".format(path))
+            self.rate = 25.
+        self.history = history
+        self.seekahead = seekahead
+        self.framesize = self.size[0] * self.size[1] * 3
+
+    def reset(self):
+        self.process = None
+        self.devnull = None
+        self.position = None
+        self.origin = None
+        self.end = None
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+
+    def seek(self, k):
+        """
+        Restarts the decoder so the next frame read from the pipe is k.
+        """
+        self.close()
+        w, h = self.size
+        cmd = [decoder()]
+        if k:
+            cmd.extend(["-ss", "{0:.6f}".format(k / self.rate)])
+        cmd.extend(["-i", self.path])
+        if self.fps:
+            cmd.extend(["-r", str(self.fps)])
+        cmd.extend(["-s", "{0}x{1}".format(w, h),
+                    "-f", "rawvideo", "-pix_fmt", "rgb24", "-"])
+        logger.debug("Decoding {0} from frame {1}".format(self.path, k))
+        self.devnull = open(os.devnull, "w")
+        self.process = subprocess.Popen(cmd, stdout = subprocess.PIPE,
+                                        stderr = self.devnull,
+                                        bufsize = self.framesize)
+        self.position = k
+        self.origin = k
+
+    def read(self):
+        """
+        Reads the next frame from the pipe, or returns None at the end. The
+        length of the video is only known once a pipe that started at the
+        first frame ends, since a seek may land past the requested frame.
+        """
+        chunk = self.process.stdout.read(self.framesize)
+        if len(chunk) < self.framesize:
+            if self.origin == 0:
+                self.end = self.position
+            self.close()
+            return None
+        w, h = self.size
+        frame = numpy.frombuffer(chunk, numpy.uint8).reshape((h, w, 3))
+        self.recent[self.position] = frame
+        if len(self.recent) > self.history:
+            self.recent.popitem(last = False)
+        self.position += 1
+        return frame
+
+    def close(self):
+        """
+        Stops the decoder, if it is running.
+        """
+        if self.process is not None:
+            self.process.stdout.close()
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+            self.process.wait()
+            self.devnull.close()
+            self.process = None
+
+    def view(self, k):
+        """
+        Returns a frame as a read only (height, width, 3) array.
+        """
+        if k < 0 or (self.end is not None and k >= self.end):
+            raise IndexError("Frame {0} is not in {1}".format(k, self.path))
+        with self.lock:
+            if k in self.recent:
+                return self.recent[k]
+            if (self.process is None or k < self.position or
+                k - self.position > self.seekahead):
+                self.seek(k)
+            while True:
+                frame = self.read()
+                if frame is None:
+                    raise IndexError("Frame {0} is not in {1}".format(k,
+                                                                  self.path))
+                if self.position - 1 == k:
+                    return frame
+
+    def __getitem__(self, k):
+        return Image.fromarray(numpy.array(self.view(k)))
+
+    def __len__(self):
+        """
+        The number of frames, estimated from the duration of the video until
+        the end of the pipe has been reached.
+        """
+        if self.end is not None:
+            return self.end
+        if self.length is None:
+            self.length = int(round((duration(self.path) or 0) * self.rate))
+        return self.length
+
+    def __iter__(self):
+        k = 0
+        while True:
+            try:
+                yield self[k]
+            except IndexError:
+                return
+            k += 1
+
+    def __del__(self):
+        self.close()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for key in ["process", "devnull", "recent", "lock"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset()
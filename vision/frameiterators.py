@@ -1,6 +1,11 @@
 from PIL import Image
+from collections import OrderedDict, deque
+import threading
+import logging
 import os
 
+logger = logging.getLogger("vision.frameiterators")
+
 class frameiterator(object):
     """
     A simple iterator to produce frames.
@@ -48,3 +53,183 @@ class frameiterator(object):
 class flatframeiterator(frameiterator):
     def path(self, frame):
         return "{0}/{1:05d}.jpg".format(self.base, frame)
+
+class cachediterator(object):
+    """
+    Wraps a frame iterator, such as frameiterator, flatframeiterator or
+    ffmpeg.extract, and keeps recently decoded frames in memory, bounded by
+    capacity bytes. A background thread decodes the next prefetch frames in
+    the direction of access, so sequential reads rarely wait for a decode.
+
+    Indexing returns a copy of the cached frame, because callers such as
+    visualize draw on the images they are given. The hits, misses and
+    prefetched counters show how well the cache is sized.
+
+    >>> video = cachediterator(frameiterator("/scratch/frames/"))
+    >>> dp.track(start, stop, model, video)
+    >>> video.hits, video.misses
+    """
+    def __init__(self, images, capacity = 512 * 1024 * 1024, prefetch = 8):
+        self.images = images
+        self.capacity = capacity
+        self.prefetch = prefetch
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.reset()
+
+    def reset(self):
+        self.frames = OrderedDict()
+        self.bytes = 0
+        self.pending = set()
+        self.queue = deque()
+        self.last = None
+        self.direction = 1
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+
+    def decode(self, frame):
+        image = self.images[frame]
+        image.load()
+        return image
+
+    def store(self, frame, image):
+        """
+        Inserts a decoded frame and evicts the least recently used frames
+        until the cache fits. Must be called with the condition held.
+        """
+        if frame in self.frames:
+            return
+        self.frames[frame] = image
+        self.bytes += footprint(image)
+        while self.bytes > self.capacity and len(self.frames) > 1:
+            _, evicted = self.frames.popitem(last = False)
+            self.bytes -= footprint(evicted)
+
+    def schedule(self, frame):
+        """
+        Queues the frames after frame in the direction of access for the
+        prefetch thread. Must be called with the condition held.
+        """
+        if self.last is not None and frame != self.last:
+            self.direction = 1 if frame > self.last else -1
+        self.last = frame
+        if not self.prefetch or self.closed:
+            return
+        self.unqueue()
+        for i in range(1, self.prefetch + 1):
+            ahead = frame + i * self.direction
+            if ahead < 0:
+                break
+            if ahead not in self.frames and ahead not in self.pending:
+                self.queue.append(ahead)
+                self.pending.add(ahead)
+        if self.queue:
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.work)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+
+    def unqueue(self):
+        """
+        Drops the frames the prefetch thread has not started on. Must be
+        called with the condition held.
+        """
+        self.pending.difference_update(self.queue)
+        self.queue.clear()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                frame = self.queue.popleft()
+            try:
+                image = self.decode(frame)
+            except Exception as e:
+                logger.debug("Stopped prefetch at frame {0}: {1}".format(frame,
+                                                                         e))
+                image = None
+            with self.condition:
+                self.pending.discard(frame)
+                if image is None:
+                    self.unqueue()
+                else:
+                    self.store(frame, image)
+                    self.prefetched += 1
+                self.condition.notify_all()
+
+    def close(self):
+        """
+        Stops the prefetch thread and drops the cached frames.
+        """
+        with self.condition:
+            self.closed = True
+            self.unqueue()
+            self.frames.clear()
+            self.bytes = 0
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        logger.debug("Frame cache had {0} hits, {1} misses and {2} "
+                     "prefetched".format(self.hits, self.misses,
+                                         self.prefetched))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __getitem__(self, frame):
+        with self.condition:
+            if frame in self.queue:
+                # not started yet, so decode it here instead of waiting
+                self.queue.remove(frame)
+                self.pending.discard(frame)
+            while frame in self.pending:
+                self.condition.wait()
+            image = self.frames.pop(frame, None)
+            if image is not None:
+                self.frames[frame] = image
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.schedule(frame)
+        if image is None:
+            image = self.decode(frame)
+            with self.condition:
+                self.store(frame, image)
+        return image.copy()
+
+    def __len__(self):
+        return len(self.images)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for key in ["frames", "pending", "queue", "condition", "thread"]:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset()
+
+# bytes per pixel of the modes PIL does not store in four bytes, such as
+# RGB, which it pads to RGBX
+pixelsizes = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16B": 2, "I;16L": 2}
+
+def footprint(image):
+    """
+    Returns the number of bytes a decoded image takes in memory.
+    """
+    width, height = image.size
+    return width * height * pixelsizes.get(image.mode, 4)
@@ -21,20 +21,36 @@ class PathModel(object):
     We extract both HOG features and RGB features. 
 
     For fast scoring, use the corresponding convolution.pyx routine.
+
+    If incremental, the model keeps its features and SVM solution so that
+    update() can add new annotations without extracting the old ones again
+    or training from scratch. The features stay in this process only.
+
+    If mine is more than 0, the negatives are mined instead of sampled: the
+    model starts from a random half of cachesize negatives and, for up to
+    mine rounds, adds the background windows that violate its margin,
+    keeping the cachesize hardest negatives between rounds.
     """
 
     def __init__(self, images, givens, dim = (40,40), hogbin = 8,
                  rgbbin = 8, bgskip = 2, bgsize = 5e4, c = 0.000001,
-                 realprior = None, realpriorweight = 10):
+                 realprior = None, realpriorweight = 10, incremental = False,
+                 mine = 0, cachesize = 10000):
         """
         Constructs a path based model from the given path.
         """
         self.dim = dim
         self.hogbin = hogbin
         self.rgbbin = rgbbin
+        self.bgskip = bgskip
         self.c = c
+        self.frames = set(x.frame for x in givens)
+        self.solver = None
 
         logger.info("Extracting features from path")
+        if mine:
+            bgsize = min(bgsize, cachesize / 2)
+        self.negativesperframe = int(bgsize / len(givens))
         positives, negatives = self.extractpath(images, givens, dim,
                                                 hogbin, rgbbin, bgskip,
                                                 bgsize)
@@ -44,7 +60,15 @@ class PathModel(object):
         logger.info("Learning weights for path with {0} foregrounds and "
                     "{1} backgrounds".format(len(positives), len(negatives)))
         svm.sanity(negatives, positives)
-        model = svm.train(negatives, positives, c = c)
+        if mine:
+            negatives = self.mine(images, givens, positives, negatives,
+                                  mine, cachesize)
+        if incremental:
+            self.solver = svm.Incremental(c = c)
+            self.solver.add(negatives, positives)
+            model = self.solver.train()
+        else:
+            model = svm.train(negatives, positives, c = c)
         self.weights, self.bias = model.weights, model.bias
 
         logger.info("Weights learned with bias {0}".format(self.bias))
@@ -54,29 +78,64 @@ class PathModel(object):
         if self.realprior and not self.realprior.built:
             self.realprior.build(givens, forcescore = 1)
 
+    def update(self, images, givens):
+        """
+        Learns from the givens on frames the model has not seen yet. Only
+        their features are extracted, with as many random negatives per
+        frame as the model started from (after the cachesize limit when
+        mining), and the SVM is trained again starting from its previous
+        solution.
+        """
+        if getattr(self, "solver", None) is None:
+            raise RuntimeError("Model was not built incremental, so it "
+                               "cannot be updated")
+        givens = [x for x in givens if x.frame not in self.frames]
+        if not givens:
+            return self
+
+        logger.info("Updating model with {0} new frames".format(len(givens)))
+        positives, negatives = self.extractpath(images, givens, self.dim,
+                                                self.hogbin, self.rgbbin,
+                                                self.bgskip,
+                                                self.negativesperframe *
+                                                len(givens))
+        self.solver.add(negatives, positives)
+        model = self.solver.train()
+        self.weights, self.bias = model.weights, model.bias
+        self.frames.update(x.frame for x in givens)
+
+        logger.info("Weights updated with bias {0}".format(self.bias))
+        return self
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["solver"] = None
+        return state
+
     def extractpath(self, images, givens, dim, 
                     int hogbin, int rgbbin, int bgskip, int bgsize):
         """
         Extracts features from a path.
+
+        Returns the positives and the negatives as 2-D matrices with one
+        example per row. Negatives are windows every bgskip pixels that
+        overlap the given box by less than half, sampled down to bgsize over
+        the whole path.
         """
         cdef int dimw = dim[0], dimh = dim[1]
         cdef int imw, imh
-        cdef int i, j, xtl, ytl, xbr, ybr
+        cdef int xtl, ytl, xbr, ybr
+        cdef int count = 0, numfeat
         cdef double wr, hr
         cdef annotations.Box given
 
-        cdef numpy.ndarray[ndim=3, dtype=numpy.double_t] hogim
-
         positives = []
-        negatives = []
+        negatives = None
         negativesperframe = int(bgsize / len(givens))
         for given in givens:
             logger.debug("Extracting features from "
                          "frame {0}".format(given.frame))
-            wr = float(dim[0]) / given.width
-            hr = float(dim[1]) / given.height
-            im = images[given.frame]
-            im = im.resize((int(im.size[0]*wr), int(im.size[1]*hr)), 2)
+            im, wr, hr = self.resized(images, given)
             imw, imh = im.size
             mapped = given.transform(wr, hr)
             mapped.xbr = mapped.xtl + dim[0]
@@ -105,38 +164,176 @@ class PathModel(object):
 #                    rgbpatch = features.rgbhist(patch, self.rgbbin).flatten()
 #                    positives.append(numpy.append(hogpatch, rgbpatch))
 
+            if negatives is None:
+                numfeat = positives[0].size
+                negatives = numpy.empty((negativesperframe * len(givens),
+                                         numfeat))
+
             logger.debug("Extracting negatives")
 
             # negatives
-            hogim = features.hog(im, hogbin)
-            hogim = features.hogpad(hogim)
-            framenegatives = []
-            for i from 0 <= i < imw-dimw by bgskip:
-                for j from 0 <= j < imh-dimh by bgskip:
-                    if annotations.Box(i/wr, j/hr, (i + dimw)/wr,
-                        (j + dimh)/hr).percentoverlap(given) < 0.5:
-                        framenegatives.append((i, j))
+            xs, ys = self.backgrounds(given, imw, imh, wr, hr, bgskip)
 
             logger.debug("Sampling negatives")
-            if len(framenegatives) > negativesperframe:
-                framenegatives = random.sample(framenegatives,
-                                               negativesperframe)
+            if xs.size > negativesperframe:
+                chosen = random.sample(xrange(xs.size), negativesperframe)
+                xs, ys = xs[chosen], ys[chosen]
+            if xs.size == 0:
+                continue
+
+            self.windowfeatures(im, xs, ys,
+                                out = negatives[count:count + xs.size])
+            count += xs.size
+
+        if negatives is None:
+            negatives = numpy.empty((0, 0))
+        return numpy.array(positives), negatives[:count]
+
+    def mine(self, images, givens, positives, negatives, int rounds,
+             int cachesize):
+        """
+        Mines hard negatives over rounds, starting from the given negatives.
+
+        Each round trains on the cache, scores every frame of the givens
+        with convolution.hogrgbmean and adds the background windows whose
+        score is inside the margin, hardest first and up to an equal share
+        of the cache per frame. When the cache is over cachesize, the
+        easiest negatives are evicted. Stops early when a round finds no
+        new hard negative. Returns the cache.
+        """
+        cdef int perframe = max(cachesize / len(givens), 1)
+        seen = set(x.tostring() for x in negatives)
+
+        for iteration in range(rounds):
+            model = svm.train(negatives, positives, c = self.c)
+            self.weights, self.bias = model.weights, model.bias
+
+            found = []
+            for given in givens:
+                im, wr, hr = self.resized(images, given)
+                hogim = features.hogpad(features.hog(im, self.hogbin))
+                cost = convolution.hogrgbmean(im, self.dim,
+                                              self.hogweights(),
+                                              self.rgbweights(),
+                                              hogbin = self.hogbin,
+                                              hogfeat = hogim)
+                xs, ys = self.backgrounds(given, im.size[0], im.size[1],
+                                          wr, hr, self.bgskip)
+                inside = (xs < cost.shape[0]) & (ys < cost.shape[1])
+                xs, ys = xs[inside], ys[inside]
+                scores = cost[xs, ys] + self.bias
+                hard = numpy.nonzero(scores < 1)[0]
+                hard = hard[numpy.argsort(scores[hard])][:perframe]
+                if hard.size == 0:
+                    continue
+                windows = self.windowfeatures(im, xs[hard], ys[hard], hogim)
+                fresh = []
+                for i, window in enumerate(windows):
+                    key = window.tostring()
+                    if key not in seen:
+                        seen.add(key)
+                        fresh.append(i)
+                found.append(windows[fresh])
+
+            found = [x for x in found if len(x)]
+            if not found:
+                logger.info("Mining round {0} found no hard negatives"
+                            .format(iteration))
+                break
+
+            negatives = numpy.vstack([negatives] + found)
+            logger.info("Mining round {0} added {1} hard negatives"
+                        .format(iteration, sum(len(x) for x in found)))
+            if len(negatives) > cachesize:
+                margins = numpy.dot(negatives, self.weights) + self.bias
+                keep = numpy.argsort(margins, kind = "mergesort")[:cachesize]
+                keep.sort()
+                negatives = negatives[keep]
+                seen = set(x.tostring() for x in negatives)
+        return negatives
 
-            for i, j in framenegatives: 
-                hogj = j/hogbin 
-                hogjs = (j+dimh)/hogbin 
-                hogi = i/hogbin 
-                hogis = (i+dimw)/hogbin 
+    def resized(self, images, annotations.Box given):
+        """
+        Returns the frame of a given box resized so the box has size dim, and
+        the resize ratios.
+        """
+        wr = float(self.dim[0]) / given.width
+        hr = float(self.dim[1]) / given.height
+        im = images[given.frame]
+        im = im.resize((int(im.size[0]*wr), int(im.size[1]*hr)), 2)
+        return im, wr, hr
 
-                hogpatch = hogim[hogj:hogjs, hogi:hogis, :]
-                hogpatch = hogpatch.flatten()
+    def windowfeatures(self, im, xs, ys, hogim = None, out = None):
+        """
+        Returns the features of the windows with top left corners at xs and
+        ys in a resized frame, one window per row, written into out if it is
+        given. hogim is the padded HOG map of the frame, if already known.
+        """
+        if hogim is None:
+            hogim = features.hogpad(features.hog(im, self.hogbin))
+        hog = self.gatherhog(hogim, xs, ys, self.hogbin)
+        hogsize = hog.shape[1]
+        if out is None:
+            out = numpy.empty((xs.size, hogsize + 9))
+        out[:, :hogsize] = hog
+        out[:, hogsize:] = self.gatherrgb(im, xs, ys)
+        return out
 
-                rgbpatchregion = (i, j, i+dimw, j+dimh)
-                rgbpatch = features.rgbmean(im.crop(rgbpatchregion))
-                rgbpatch = rgbpatch.flatten()
+    def backgrounds(self, annotations.Box given, int imw, int imh,
+                    double wr, double hr, int bgskip):
+        """
+        Finds the top left corners, in the resized image, of the windows
+        every bgskip pixels that overlap the given box by less than half.
+        Corners are ordered by x, then by y.
+        """
+        cdef int dimw = self.dim[0], dimh = self.dim[1]
+        i = numpy.arange(0, max(imw - dimw, 0), bgskip)
+        j = numpy.arange(0, max(imh - dimh, 0), bgskip)
+
+        # the window corners mapped back to the frame, as Box truncates them
+        xtl = (i / wr).astype(numpy.int)[:, None]
+        xbr = ((i + dimw) / wr).astype(numpy.int)[:, None]
+        ytl = (j / hr).astype(numpy.int)[None, :]
+        ybr = ((j + dimh) / hr).astype(numpy.int)[None, :]
+
+        xdiff = numpy.minimum(xbr, given.xbr) - numpy.maximum(xtl, given.xtl)
+        ydiff = numpy.minimum(ybr, given.ybr) - numpy.maximum(ytl, given.ytl)
+        intersection = numpy.maximum(xdiff, 0) * numpy.maximum(ydiff, 0)
+        union = (xbr - xtl) * (ybr - ytl) + given.area - intersection
+        overlap = intersection / union.astype(numpy.double)
+
+        xs, ys = numpy.nonzero(overlap < 0.5)
+        return i[xs], j[ys]
+
+    def gatherhog(self, hogim, xs, ys, int hogbin):
+        """
+        Gathers the flattened HOG cells under windows with top left corners
+        at xs and ys from a padded HOG map, through a strided view that
+        holds every window of cells.
+        """
+        cells = self.dim[1] / hogbin, self.dim[0] / hogbin
+        rows, cols, z = hogim.shape
+        hogim = numpy.ascontiguousarray(hogim)
+        strides = hogim.strides
+        windows = numpy.lib.stride_tricks.as_strided(hogim,
+            shape = (rows - cells[0] + 1, cols - cells[1] + 1,
+                     cells[0], cells[1], z),
+            strides = (strides[0], strides[1]) + strides)
+        patches = windows[ys / hogbin, xs / hogbin]
+        return patches.reshape((xs.size, -1))
 
-                negatives.append(numpy.append(hogpatch, rgbpatch))
-        return positives, negatives
+    def gatherrgb(self, im, xs, ys):
+        """
+        Computes the RGB means and covariances, as rgbmean() does, of the
+        windows with top left corners at xs and ys from a summed area table.
+        """
+        cdef int dimw = self.dim[0], dimh = self.dim[1]
+        sumrgb = convolution.rgbintegral(im)
+        table = numpy.zeros((sumrgb.shape[0] + 1, sumrgb.shape[1] + 1, 9))
+        table[1:, 1:, :] = sumrgb
+        sums  = table[xs + dimw, ys + dimh] + table[xs, ys]
+        sums -= table[xs, ys + dimh] + table[xs + dimw, ys]
+        return sums / (dimw * dimh)
 
     def hogweights(self):
         """
@@ -154,32 +351,236 @@ class PathModel(object):
         y = self.dim[1]/self.hogbin
         return self.weights[x*y*13:]
 
-    def scoreframe(self, image, size, frame = None):
+    def scoreframe(self, image, size, frame = None, pyramid = None):
+        """
+        Scores every location of a box with the given size in an image.
+
+        If a feature pyramid of the image is given, the features are shared
+        from its nearest level and the costs are sampled back onto the grid
+        that resizing the image directly would produce.
+        """
         # resize image to so box has 'dim' in the resized space
-        cdef int i, j, width, height, dim0, dim1
-        cdef double rpw = self.realpriorweight
-        cdef double probsum = 0
-        cdef numpy.ndarray[ndim=2, dtype=numpy.double_t] proj
+        width, height = image.size
+        wr = self.dim[0] / <double>(size[0])
+        hr = self.dim[1] / <double>(size[1])
+
+        if pyramid is None:
+            rimage = image.resize((int(ceil(width * wr)),
+                                   int(ceil(height * hr))), 2)
+            cost = convolution.hogrgbmean(rimage, self.dim,
+                                    self.hogweights(),
+                                    self.rgbweights(),
+                                    hogbin = self.hogbin)
+        else:
+            cost = self.scorelevel(pyramid, size, wr, hr)
 
+        return self.scoreprior(cost, image.size, wr, hr, frame, pyramid)
+
+    def scorelevel(self, pyramid, size, double wr, double hr):
+        """
+        Scores the nearest level of a feature pyramid and maps the costs onto
+        the grid for the exact resize ratios wr and hr.
+        """
+        level = self.level(pyramid, size)
+        cost = convolution.hogrgbmean(level.image, self.dim,
+                                      self.hogweights(),
+                                      self.rgbweights(),
+                                      hogbin = self.hogbin,
+                                      hogfeat = level.hog,
+                                      sumrgb = level.sumrgb)
+        return self.resample(cost, level, pyramid.size, wr, hr)
+
+    def scoreshrunk(self, image, size, int shrink, frame = None):
+        """
+        Scores every location of a box like scoreframe(), but from an image
+        shrink times smaller with HOG cells shrink times smaller, so the
+        cells cover the same pixels and the learned weights still apply.
+        The costs are repeated back onto the grid scoreframe() returns. They
+        are a cheap approximation, meant for a coarse pass.
+        """
+        if self.hogbin % shrink or self.dim[0] % shrink or \
+           self.dim[1] % shrink:
+            raise ValueError("Cannot shrink a model with hogbin {0} and dim "
+                             "{1} by {2}".format(self.hogbin, self.dim,
+                                                 shrink))
+        width, height = image.size
+        wr = self.dim[0] / <double>(size[0])
+        hr = self.dim[1] / <double>(size[1])
+        rwidth = int(ceil(width * wr))
+        rheight = int(ceil(height * hr))
+
+        rimage = image.resize((int(ceil(rwidth / <double>(shrink))),
+                               int(ceil(rheight / <double>(shrink)))), 2)
+        dim = (self.dim[0] // shrink, self.dim[1] // shrink)
+        small = convolution.hogrgbmean(rimage, dim,
+                                       self.hogweights(),
+                                       self.rgbweights(),
+                                       hogbin = self.hogbin // shrink)
+
+        w = rwidth - self.dim[0]
+        h = rheight - self.dim[1]
+        cost = numpy.repeat(numpy.repeat(small, shrink, axis = 0), shrink,
+                            axis = 1)
+        if cost.shape[0] < w or cost.shape[1] < h:
+            cost = numpy.pad(cost, ((0, max(w - cost.shape[0], 0)),
+                                    (0, max(h - cost.shape[1], 0))), "edge")
+        cost = numpy.ascontiguousarray(cost[:w, :h])
+        return self.scoreprior(cost, image.size, wr, hr, frame)
+
+    def scoreregion(self, image, size, region, frame = None):
+        """
+        Scores the locations of a box like scoreframe(), but only those with
+        their top left corner in region, given as (xtl, ytl, xbr, ybr) in
+        pixels of the image with exclusive ends. Only a crop around region
+        is resized and scored, starting on a HOG cell of the full grid. The
+        costs come back on the full grid and are infinite away from region.
+        """
         width, height = image.size
-        dim0, dim1 = self.dim
         wr = self.dim[0] / <double>(size[0])
         hr = self.dim[1] / <double>(size[1])
-        rimage = image.resize((int(ceil(width * wr)), int(ceil(height * hr))), 2)
-
-        cost = convolution.hogrgbmean(rimage, self.dim,
-                                self.hogweights(),
-                                self.rgbweights(),
-                                hogbin = self.hogbin)
-
-        if self.realprior and frame and self.realprior.hasprojection(frame):
-            proj = self.realprior.scorelocations(frame)
-            proj = convolution.sumprob(proj, self.dim)
-            for i from 0 <= i < <int>(width * wr - dim0):
-                for j from 0 <= j < <int>(height * hr - dim1):
-                    probsum = proj[<int>(i / wr), <int>(j / hr)]
-                    probsum += proj[<int>((i + dim0) / wr), <int>((j + dim1) / hr)]
-                    probsum -= proj[<int>(i / wr), <int>((j + dim1) / hr)]
-                    probsum -= proj[<int>((i + dim0) / wr), <int>(j / hr)]
-                    cost[i, j] += cost[i, j] - rpw * probsum
+        rwidth = int(ceil(width * wr))
+        rheight = int(ceil(height * hr))
+        hogbin = self.hogbin
+
+        # one extra cell around the region keeps the block normalization at
+        # the border of the crop away from the scored cells
+        xtl, ytl, xbr, ybr = region
+        rxtl = max(int(xtl * wr) // hogbin - 1, 0) * hogbin
+        rytl = max(int(ytl * hr) // hogbin - 1, 0) * hogbin
+        rxbr = min(int(ceil(xbr * wr)) + self.dim[0] + 2 * hogbin, rwidth)
+        rybr = min(int(ceil(ybr * hr)) + self.dim[1] + 2 * hogbin, rheight)
+
+        crop = image.crop((int(round(rxtl / wr)), int(round(rytl / hr)),
+                           min(int(ceil(rxbr / wr)), width),
+                           min(int(ceil(rybr / hr)), height)))
+        crop = crop.resize((rxbr - rxtl, rybr - rytl), 2)
+        local = convolution.hogrgbmean(crop, self.dim,
+                                       self.hogweights(),
+                                       self.rgbweights(),
+                                       hogbin = hogbin)
+
+        cost = numpy.empty((rwidth - self.dim[0], rheight - self.dim[1]))
+        cost.fill(numpy.inf)
+        w = min(local.shape[0], cost.shape[0] - rxtl)
+        h = min(local.shape[1], cost.shape[1] - rytl)
+        if w > 0 and h > 0:
+            cost[rxtl:rxtl + w, rytl:rytl + h] = local[:w, :h]
+        return self.scoreprior(cost, image.size, wr, hr, frame)
+
+    def level(self, pyramid, size):
+        """
+        Returns the level of a feature pyramid used to score a box size.
+        """
+        if pyramid.sbin != self.hogbin:
+            raise ValueError("Pyramid has sbin {0}, but model uses {1}"
+                             .format(pyramid.sbin, self.hogbin))
+        return pyramid.level(size, self.dim)
+
+    def resample(self, cost, level, imagesize, double wr, double hr):
+        """
+        Samples the costs of a pyramid level onto the grid that resizing an
+        image of imagesize by wr and hr would produce.
+        """
+        width, height = imagesize
+        xs = numpy.arange(int(ceil(width * wr)) - self.dim[0])
+        ys = numpy.arange(int(ceil(height * hr)) - self.dim[1])
+        xs = (xs * (level.xscale / wr)).astype(numpy.int)
+        ys = (ys * (level.yscale / hr)).astype(numpy.int)
+        xs = numpy.clip(xs, 0, cost.shape[0] - 1)
+        ys = numpy.clip(ys, 0, cost.shape[1] - 1)
+        return cost[numpy.ix_(xs, ys)]
+
+    def scoreprior(self, cost, imagesize, double wr, double hr, frame = None,
+                   pyramid = None):
+        """
+        Adds the real world prior to the costs of a frame, if there is one.
+        The summed area table of the prior is shared through the feature
+        pyramid of the frame when one is given.
+        """
+        cdef double rpw = self.realpriorweight
+        cdef int width, height, dim0, dim1
+
+        if not (self.realprior and frame and
+                self.realprior.hasprojection(frame)):
+            return cost
+
+        width, height = imagesize
+        dim0, dim1 = self.dim
+
+        if pyramid is not None:
+            proj = pyramid.sumprob(self.realprior, frame)
+        else:
+            proj = convolution.sumprob(self.realprior.scorelocations(frame))
+
+        # look up the corners of every window in the original image
+        xs = numpy.arange(max(<int>(width * wr - dim0), 0))
+        ys = numpy.arange(max(<int>(height * hr - dim1), 0))
+        xtl = numpy.minimum((xs / wr).astype(numpy.int), proj.shape[0] - 1)
+        ytl = numpy.minimum((ys / hr).astype(numpy.int), proj.shape[1] - 1)
+        xbr = numpy.minimum(((xs + dim0) / wr).astype(numpy.int),
+                            proj.shape[0] - 1)
+        ybr = numpy.minimum(((ys + dim1) / hr).astype(numpy.int),
+                            proj.shape[1] - 1)
+
+        probsum  = proj[numpy.ix_(xtl, ytl)] + proj[numpy.ix_(xbr, ybr)]
+        probsum -= proj[numpy.ix_(xtl, ybr)] + proj[numpy.ix_(xbr, ytl)]
+
+        region = cost[0:xs.shape[0], 0:ys.shape[0]]
+        region += region - rpw * probsum
         return cost
+
+def scoreframes(models, image, sizes, frame = None, pyramid = None):
+    """
+    Scores many path models against one frame, sharing work between them.
+
+    models and sizes are parallel lists of path models and the box size each
+    one should score. Models that resize the frame to the same resolution,
+    or to the same level of the feature pyramid if one is given, share one
+    set of features and their weights are stacked so the whole group is
+    scored with a single matrix product.
+
+    Returns a list with the cost map of each model, as scoreframe() would.
+    """
+    width, height = image.size
+    groups = {}
+    for index, (model, size) in enumerate(zip(models, sizes)):
+        if pyramid is not None:
+            level = model.level(pyramid, size)
+            key = (model.dim, model.hogbin, level.xscale, level.yscale)
+        else:
+            wr = model.dim[0] / <double>(size[0])
+            hr = model.dim[1] / <double>(size[1])
+            key = (model.dim, model.hogbin,
+                   int(ceil(width * wr)), int(ceil(height * hr)))
+        groups.setdefault(key, []).append(index)
+
+    logger.debug("Scoring {0} models in {1} groups".format(len(models),
+                                                         len(groups)))
+
+    costs = [None] * len(models)
+    for (dim, hogbin, _, _), members in groups.items():
+        first = members[0]
+        if pyramid is not None:
+            level = models[first].level(pyramid, sizes[first])
+            rimage, hogfeat, sumrgb = level.image, level.hog, level.sumrgb
+        else:
+            wr = dim[0] / <double>(sizes[first][0])
+            hr = dim[1] / <double>(sizes[first][1])
+            rimage = image.resize((int(ceil(width * wr)),
+                                   int(ceil(height * hr))), 2)
+            hogfeat, sumrgb = None, None
+
+        hogfilters = numpy.array([models[x].hogweights() for x in members])
+        rgbfilters = numpy.array([models[x].rgbweights() for x in members])
+        stacked = convolution.hogrgbmeanbatch(rimage, dim, hogfilters,
+                                              rgbfilters, hogbin, hogfeat,
+                                              sumrgb)
+
+        for x, cost in zip(members, stacked):
+            wr = dim[0] / <double>(sizes[x][0])
+            hr = dim[1] / <double>(sizes[x][1])
+            if pyramid is not None:
+                cost = models[x].resample(cost, level, image.size, wr, hr)
+            costs[x] = models[x].scoreprior(cost, image.size, wr, hr, frame,
+                                            pyramid)
+    return costs
@@ -0,0 +1,152 @@
+"""
+Feature pyramids that let every model scoring a frame share its features.
+
+>>> pyramids = PyramidCache(frameiterator("/scratch/frames/"), sbin = 8)
+>>> cost = model.scoreframe(video[10], box.size, 10, pyramid = pyramids[10])
+"""
+
+import features
+import convolution
+import logging
+import threading
+from math import log, ceil
+
+logger = logging.getLogger("vision.pyramid")
+
+class Level(object):
+    """
+    A single scale of a frame. The resized image and its features are only
+    computed the first time they are requested.
+    """
+    def __init__(self, image, xscale, yscale, sbin):
+        self.xscale = xscale
+        self.yscale = yscale
+        self.sbin = sbin
+        width, height = image.size
+        self.image = image.resize((int(ceil(width * xscale)),
+                                   int(ceil(height * yscale))), 2)
+        self._hog = None
+        self._sumrgb = None
+
+    @property
+    def size(self):
+        return self.image.size
+
+    @property
+    def hog(self):
+        """
+        The padded HOG features of this level.
+        """
+        if self._hog is None:
+            self._hog = features.hogpad(features.hog(self.image, self.sbin))
+        return self._hog
+
+    @property
+    def sumrgb(self):
+        """
+        The summed area tables of the color moments of this level.
+        """
+        if self._sumrgb is None:
+            self._sumrgb = convolution.rgbintegral(self.image)
+        return self._sumrgb
+
+class FeaturePyramid(object):
+    """
+    Caches the features of one frame over a discrete set of scales.
+
+    Scales are spaced interval steps per octave along each axis, and a
+    request for any box size is served by the nearest scale. Levels are
+    built lazily, so boxes of similar sizes share the same features no
+    matter how many models or tracks ask for them.
+    """
+    def __init__(self, image, sbin = 8, interval = 10):
+        self.image = image
+        self.sbin = sbin
+        self.interval = interval
+        self.levels = {}
+        self.priors = {}
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def quantize(self, ratio):
+        """
+        Returns the index of the scale nearest to a resize ratio.
+        """
+        return int(round(log(ratio, 2) * self.interval))
+
+    def scale(self, index):
+        """
+        Returns the resize ratio for a scale index.
+        """
+        return 2 ** (index / float(self.interval))
+
+    def level(self, size, dim):
+        """
+        Returns the level that resizes a box of the given size closest to dim.
+        """
+        key = (self.quantize(dim[0] / float(size[0])),
+               self.quantize(dim[1] / float(size[1])))
+        if key not in self.levels:
+            logger.debug("Building pyramid level {0}".format(key))
+            self.levels[key] = Level(self.image, self.scale(key[0]),
+                                     self.scale(key[1]), self.sbin)
+        return self.levels[key]
+
+    def sumprob(self, realprior, frame):
+        """
+        Returns the summed area table of the real world prior for this frame,
+        computed once for every model that shares the prior.
+        """
+        key = id(realprior)
+        if key not in self.priors:
+            proj = realprior.scorelocations(frame)
+            self.priors[key] = realprior, convolution.sumprob(proj)
+        return self.priors[key][1]
+
+    def __len__(self):
+        return len(self.levels)
+
+class PyramidCache(object):
+    """
+    Builds feature pyramids over a video on demand and keeps the most recently
+    used ones. Indexing by a frame returns its pyramid.
+
+    The cache is local to a process: copies sent to a worker pool start
+    empty. Threads in one process may share it.
+    """
+    def __init__(self, images, sbin = 8, interval = 10, capacity = 10):
+        self.images = images
+        self.sbin = sbin
+        self.interval = interval
+        self.capacity = capacity
+        self.pyramids = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def __getitem__(self, frame):
+        with self.lock:
+            if frame in self.pyramids:
+                self.order.remove(frame)
+            else:
+                self.pyramids[frame] = FeaturePyramid(self.images[frame],
+                                                      self.sbin, self.interval)
+                if len(self.order) >= self.capacity:
+                    del self.pyramids[self.order.pop(0)]
+            self.order.append(frame)
+            return self.pyramids[frame]
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["pyramids"] = {}
+        state["order"] = []
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
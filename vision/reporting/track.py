@@ -20,6 +20,7 @@ from vision import annotations
 from vision import frameiterator, readpaths
 from vision.alearn import marginals
 from vision import visualize
+from vision.pyramid import PyramidCache
 from math import ceil, floor
 import itertools
 import pylab
@@ -57,6 +58,20 @@ class Engine(object):
         """
         raise NotImplementedError("color() must be implemented")
 
+    def pyramids(self, video):
+        """
+        Returns a cache of feature pyramids shared by every path in the video,
+        or None if the engine does not use feature pyramids.
+        """
+        interval = getattr(self, "interval", None)
+        if interval is None:
+            return None
+        cache = getattr(self, "_pyramids", None)
+        if cache is None or cache.images is not video:
+            cache = PyramidCache(video, self.hogbin, interval, self.cachesize)
+            self._pyramids = cache
+        return cache
+
 class FixedRateEngine(Engine):
     """
     An abstract engine that uses a fixed skip interval (e.g., linear
@@ -93,19 +108,33 @@ class FixedRateEngine(Engine):
                 logger.info("ID {0} has {1} clicks for {2} frames".format(id,
                     clicksinschedule, len(gtruths[id])))
 
+            givens = {}
+            lasts = {}
             for id, gtruth in gtruths.items():
                 skip = int(ceil(float(gtruth[-1].frame - gtruth[0].frame) / schedule[id]))
                 given = gtruth[::skip]
-                given = given[:schedule[id]]
+                givens[id] = given[:schedule[id]]
+                lasts[id] = gtruth[-1].frame
 
+            for id, path in self.predictmany(video, givens, lasts,
+                                             pool).items():
                 if id not in result:
                     result[id] = {}
-                logger.info("Processing {0} with {1} clicks".format(id, 
-                    schedule[id]))
-                result[id][cpf] = self.predict(video, given, gtruth[-1].frame,
-                                               pool = pool)
+                result[id][cpf] = path
         return result
 
+    def predictmany(self, video, givens, lasts, pool):
+        """
+        Predicts every path in the video. givens and lasts map each path to
+        its sparse path and its last frame. By default, each path is
+        predicted on its own with predict().
+        """
+        result = {}
+        for id, given in givens.items():
+            logger.info("Processing {0} with {1} clicks".format(id,
+                len(given)))
+            result[id] = self.predict(video, given, lasts[id], pool = pool)
+        return result
 
     def predict(self, video, given, last, pool):
         """
@@ -134,13 +163,36 @@ class DynamicProgrammingEngine(FixedRateEngine):
     """
     Uses a dynamic programming based tracker to predict the missing
     annotations.
+
+    If many and interval is set, all the paths in a video are filled
+    together so that each frame is scored once for every path through it,
+    and paths whose boxes fall on the same level of the feature pyramid
+    share its features. Without pyramids, boxes of different sizes would
+    share nothing, so many is ignored.
     """
-    def __init__(self, pairwisecost = 0.001, upperthreshold = 10, skip = 3, rgbbin = 8, hogbin = 8):
+    def __init__(self, pairwisecost = 0.001, upperthreshold = 10, skip = 3, rgbbin = 8, hogbin = 8,
+                 interval = None, cachesize = 100, many = False):
         self.pairwisecost = pairwisecost
         self.upperthreshold = upperthreshold
         self.skip = skip
         self.rgbbin = rgbbin
         self.hogbin = hogbin
+        self.interval = interval
+        self.cachesize = cachesize
+        self.many = many
+
+    def predictmany(self, video, givens, lasts, pool):
+        if not self.many or self.interval is None:
+            return FixedRateEngine.predictmany(self, video, givens, lasts,
+                                               pool)
+        logger.info("Processing {0} paths together".format(len(givens)))
+        return dp.fillmany(givens, video, lasts, pool = pool,
+                           pairwisecost = self.pairwisecost,
+                           upperthreshold = self.upperthreshold,
+                           skip = self.skip,
+                           rgbbin = self.rgbbin,
+                           hogbin = self.hogbin,
+                           pyramids = self.pyramids(video))
 
     def predict(self, video, given, last, pool):
         return dp.fill(given, video, last = last, pool = pool,
@@ -148,7 +200,8 @@ class DynamicProgrammingEngine(FixedRateEngine):
                        upperthreshold = self.upperthreshold,
                        skip = self.skip,
                        rgbbin = self.rgbbin,
-                       hogbin = self.hogbin)
+                       hogbin = self.hogbin,
+                       pyramids = self.pyramids(video))
 
     def color(self):
         return "r"
@@ -156,9 +209,19 @@ class DynamicProgrammingEngine(FixedRateEngine):
 class ActiveLearnDPEngine(Engine):
     """
     Uses an active learning approach to annotate the most informative frames.
+
+    If incremental, each track keeps a marginals.SegmentCache between
+    clicks, so a click only solves the segments it splits. The model is
+    relearned every retrain clicks, by default every click, or never with
+    None. If warm, relearning adds the new clicks to the model and warm
+    starts its SVM instead of learning it from scratch. If exact, relearning
+    drops the cached segments, which keeps the picks exact at the cost of
+    solving the whole track again.
     """
     def __init__(self, pairwisecost = 0.001, upperthreshold = 10, sigma = .1,
-                 erroroverlap = 0.5, skip = 3, rgbbin = 8, hogbin = 8):
+                 erroroverlap = 0.5, skip = 3, rgbbin = 8, hogbin = 8,
+                 interval = None, cachesize = 100, incremental = False,
+                 retrain = 1, warm = False, exact = False):
         self.pairwisecost = pairwisecost
         self.upperthreshold = upperthreshold
         self.sigma = sigma
@@ -166,13 +229,24 @@ class ActiveLearnDPEngine(Engine):
         self.skip = skip
         self.rgbbin = rgbbin
         self.hogbin = hogbin
+        self.interval = interval
+        self.cachesize = cachesize
+        self.incremental = incremental
+        self.retrain = retrain
+        self.warm = warm
+        self.exact = exact
 
     def __call__(self, video, gtruths, cpfs, pool = None):
         result = {}
         pathdict = {}
+        caches = {}
         for id, gtruth in gtruths.items():
             gtruth.sort(key = lambda x: x.frame)
             pathdict[id] = dict((x.frame, x) for x in gtruth)
+            if self.incremental:
+                caches[id] = marginals.SegmentCache(self.retrain,
+                                                     warm = self.warm,
+                                                     exact = self.exact)
 
         requests = {}
         for id, gtruth in gtruths.items():
@@ -185,7 +259,9 @@ class ActiveLearnDPEngine(Engine):
                                          erroroverlap = self.erroroverlap,
                                          skip = self.skip,
                                          rgbbin = self.rgbbin,
-                                         hogbin = self.hogbin)
+                                         hogbin = self.hogbin,
+                                         pyramids = self.pyramids(video),
+                                         cache = caches.get(id))
                                                      
             requests[id] = (score, frame, predicted, [gtruth[0]])
             result[id] = {}
@@ -214,7 +290,9 @@ class ActiveLearnDPEngine(Engine):
                                         erroroverlap = self.erroroverlap,
                                         skip = self.skip,
                                         rgbbin = self.rgbbin,
-                                        hogbin = self.hogbin)
+                                        hogbin = self.hogbin,
+                                        pyramids = self.pyramids(video),
+                                        cache = caches.get(id))
 
                 requests[id] = (score, frame, predicted, givens)
                 usedclicks += 1
@@ -0,0 +1,205 @@
+"""
+Shares decoded frames and cost maps with worker processes through memory
+mapped files, so work orders sent through a multiprocessing pool carry small
+handles instead of pickled images and arrays.
+
+>>> frames = SharedFrames(video, range(100, 200))
+>>> costs = SharedCosts()
+>>> orders = [(frames, start, x, model, None, costs) for x in range(100, 200)]
+>>> pool.map(dp.scoreframe, orders)
+>>> cost = costs[150]
+
+SharedObject does the same for any picklable object, such as a model that
+every work order needs: workers load it once instead of once per order.
+
+Files are placed in /dev/shm when it exists, so they never touch the disk.
+Only the process that created a buffer removes its files on close().
+"""
+
+from PIL import Image
+from collections import OrderedDict
+import cPickle as pickle
+import numpy
+import tempfile
+import shutil
+import logging
+import os
+
+logger = logging.getLogger("vision.sharedmem")
+
+# the objects most recently loaded by this process, by the path of their
+# SharedObject, at most keep of them
+loaded = OrderedDict()
+keep = 2
+
+def scratch():
+    """
+    Returns a new directory for shared files, in memory if possible.
+    """
+    if os.path.isdir("/dev/shm"):
+        return tempfile.mkdtemp(prefix = "pyvision-", dir = "/dev/shm")
+    return tempfile.mkdtemp(prefix = "pyvision-")
+
+class SharedBuffer(object):
+    """
+    Base class for buffers that pickle as a handle to their directory.
+    """
+    def __init__(self, root = None):
+        self.owner = os.getpid()
+        self.root = root or scratch()
+
+    def close(self):
+        """
+        Removes the files of the buffer, if this process created them.
+        """
+        if os.getpid() == self.owner and os.path.isdir(self.root):
+            shutil.rmtree(self.root, ignore_errors = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+class SharedFrames(SharedBuffer):
+    """
+    Holds some frames of a video in a shared uint8 array. Indexing by a
+    frame number returns a PIL image of that frame, so it can stand in for
+    the video in a work order.
+
+    Each frame is decoded into its slot by the first process that asks for
+    it, so the workers decode in parallel rather than the creating process
+    decoding every frame before any work is sent. The video travels with the
+    buffer, as it would in a plain work order. If eager, the creating
+    process decodes every frame up front instead and the video stays behind.
+    """
+    def __init__(self, images, frames, root = None, eager = False):
+        SharedBuffer.__init__(self, root)
+        self.frames = dict((frame, i) for i, frame in enumerate(frames))
+        self.length = len(images)
+
+        first = images[frames[0]].convert("RGB")
+        width, height = first.size
+        self.shape = (len(frames), height, width, 3)
+        self.path = os.path.join(self.root, "frames.raw")
+        self.readypath = os.path.join(self.root, "ready.raw")
+        data = numpy.memmap(self.path, dtype = numpy.uint8, mode = "w+",
+                            shape = self.shape)
+        ready = numpy.memmap(self.readypath, dtype = numpy.uint8,
+                             mode = "w+", shape = (len(frames),))
+        data[0] = numpy.asarray(first)
+        ready[0] = 1
+        if eager:
+            for frame, i in self.frames.items():
+                if i:
+                    data[i] = numpy.asarray(images[frame].convert("RGB"))
+                    ready[i] = 1
+            self.images = None
+        else:
+            self.images = images
+        data.flush()
+        ready.flush()
+        self._data = data
+        self._ready = ready
+
+        logger.debug("Shared {0} frames in {1}".format(len(frames),
+                                                       self.root))
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = numpy.memmap(self.path, dtype = numpy.uint8,
+                                      mode = "r+", shape = self.shape)
+        return self._data
+
+    @property
+    def ready(self):
+        if self._ready is None:
+            self._ready = numpy.memmap(self.readypath, dtype = numpy.uint8,
+                                       mode = "r+", shape = (self.shape[0],))
+        return self._ready
+
+    def __getitem__(self, frame):
+        try:
+            index = self.frames[frame]
+        except KeyError:
+            raise IndexError("Frame {0} is not shared".format(frame))
+        if not self.ready[index]:
+            # two processes may both decode a frame, but they write the
+            # same pixels, and the flag is only set once they are in place
+            image = self.images[frame].convert("RGB")
+            self.data[index] = numpy.asarray(image)
+            self.ready[index] = 1
+            return image
+        return Image.fromarray(numpy.array(self.data[index]))
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_data"] = None
+        state["_ready"] = None
+        return state
+
+class SharedCosts(SharedBuffer):
+    """
+    Holds the cost maps that workers compute, one file per frame. Workers
+    put() their result and return only the frame number, and the process
+    that collects the results indexes the buffer by frame.
+    """
+    def put(self, frame, cost):
+        path = os.path.join(self.root, "{0}.npy".format(frame))
+        temporary = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(temporary, "wb") as f:
+            numpy.save(f, numpy.ascontiguousarray(cost))
+        os.rename(temporary, path)
+        return frame
+
+    def __getitem__(self, frame):
+        path = os.path.join(self.root, "{0}.npy".format(frame))
+        try:
+            return numpy.load(path, mmap_mode = "c")
+        except IOError:
+            raise KeyError(frame)
+
+    def __contains__(self, frame):
+        return os.path.exists(os.path.join(self.root, "{0}.npy".format(frame)))
+
+class SharedObject(SharedBuffer):
+    """
+    Pickles an object once into a file. The buffer pickles as a handle, and
+    get() returns the object, loading it only the first time a process asks
+    for it, so every work order in a worker shares one copy.
+    """
+    def __init__(self, obj, root = None):
+        SharedBuffer.__init__(self, root)
+        self.path = os.path.join(self.root, "object.pickle")
+        with open(self.path, "wb") as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        self._obj = obj
+
+    def get(self):
+        if self._obj is None:
+            for path in [x for x in loaded if not os.path.exists(x)]:
+                del loaded[path]
+            if self.path in loaded:
+                obj = loaded.pop(self.path)
+            else:
+                with open(self.path, "rb") as f:
+                    obj = pickle.load(f)
+            loaded[self.path] = obj
+            while len(loaded) > keep:
+                loaded.popitem(last = False)
+            self._obj = obj
+        return self._obj
+
+    def close(self):
+        loaded.pop(self.path, None)
+        self._obj = None
+        SharedBuffer.close(self)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_obj"] = None
+        return state
@@ -1,7 +1,9 @@
 import numpy as np
 cimport numpy as np
 
+import itertools
 import logging
+import time
 logger = logging.getLogger("vision.svm")
 
 cdef extern from *:
@@ -11,6 +13,10 @@ cdef extern from "stdlib.h":
     ctypedef unsigned long size_t
     void free(void *ptr)
     void *malloc(size_t size)
+    int rand() nogil
+
+cdef extern from "string.h":
+    void *memcpy(void *dest, void *src, size_t n) nogil
 
 cdef extern from "liblinear/linear.h":
     cdef struct feature_node:  
@@ -44,6 +50,7 @@ cdef extern from "liblinear/linear.h":
 
     char *check_parameter(problem *prob, parameter *param) nogil
     model *liblinear_train "train" (problem *prob, parameter *param) nogil
+    void destroy_model(model *model_) nogil
 
     cdef enum solver_type:
         L2R_LR,
@@ -81,7 +88,7 @@ def sanity(pos, neg):
     if len(neg) == 0:
         raise ValueError("Need at least one negative data point")
     size = pos[0].size
-    for x, point in enumerate(pos + neg):
+    for x, point in enumerate(itertools.chain(pos, neg)):
         if point.ndim != 1:
             raise ValueError("Each data point must be exactly "
             "1 dimension [{0}]".format(x))
@@ -97,86 +104,324 @@ cpdef train(positives, negatives, float c = 1.0,
     """
     Trains a linear SVM with positives and negatives.
 
-    positive and negative should be lists of numpy vectors with the
-    respective features. Sparse vectors are *not* supported at this time.
+    positive and negative should be 2-D matrices with one vector per row,
+    or lists of numpy vectors, with the respective features. Contiguous
+    float64 matrices are read without a copy. Sparse vectors are *not*
+    supported at this time.
 
     c is the cost of a constraint violation.
 
     eps is the stopping criterion.
 
-    Returns the learned the weights and bias through a Model object.
+    Returns the learned the weights and bias through a Model object, with
+    the seconds spent building the problem and optimizing it in marshaltime
+    and optimizetime.
     """
     logger.info("Constructing SVM problems and parameters")
+    cdef double begin = time.time()
 
-    cdef int numpos = len(positives), numneg = len(negatives)
+    cdef np.ndarray[np.double_t, ndim=2] pos = matrix(positives)
+    cdef np.ndarray[np.double_t, ndim=2] neg = matrix(negatives)
+    cdef int numpos = pos.shape[0], numneg = neg.shape[0]
     cdef int numall = numpos + numneg
-    cdef int numfeat = positives[0].size
+    cdef int numfeat = pos.shape[1]
     cdef int i # counter
+    if neg.shape[1] != numfeat:
+        raise ValueError("Positives have {0} features, but negatives have "
+                         "{1}".format(numfeat, neg.shape[1]))
 
     logger.debug("Constructing problem")
     cdef problem prob
+    cdef parameter param
+    cdef feature_node *nodes = NULL
+    cdef model *mod = NULL
+    cdef const_char_ptr message
     prob.l = numall
     prob.n = numfeat + 1
-    prob.y = <int*> malloc(numall * sizeof(int))
-    for i from 0 <= i < numpos:
-        prob.y[i] = 1
-    for i from 0 <= i < numneg:
-        prob.y[numpos + i] = -1
     prob.bias = 1
+    prob.y = <int*> malloc(numall * sizeof(int))
     prob.x = <feature_node**> malloc(numall * sizeof(feature_node*))
-    for i from 0 <= i < numpos:
-        prob.x[i] = build_feature_node(positives[i])
-    for i from 0 <= i < numneg:
-        prob.x[numpos + i] = build_feature_node(negatives[i])
+    nodes = <feature_node*> malloc(<size_t>numall * (numfeat + 2) *
+                                   sizeof(feature_node))
+    param.weight = <double*> malloc(2 * sizeof(double))
+    param.weight_label = <int*> malloc(2 * sizeof(int))
 
-    logger.debug("Constructing parameter")
-    cdef parameter param
-    param.solver_type = mach
-    param.eps = eps
-    param.C = c
-    param.nr_weight = 2
-    param.weight = <double*> malloc(param.nr_weight*sizeof(double))
-    param.weight[0] = posc
-    param.weight[1] = negc
-    param.weight_label = <int*> malloc(param.nr_weight*sizeof(int))
-    param.weight_label[0] = +1
-    param.weight_label[1] = -1
-
-    logger.debug("Checking parameters")
-    cdef const_char_ptr message = <char*> check_parameter(&prob, &param)
-    if message:
-        raise RuntimeError("Error training SVM: " + str(message))
-
-    logger.info("Optimizing SVM with liblinear")
-    cdef model *mod = liblinear_train(&prob, &param)
-    cdef np.ndarray[np.double_t, ndim=1] weights = np.zeros(mod.nr_feature)
-    for i from 0 <= i < mod.nr_feature:
-        weights[i] = mod.w[i]
-    cdef double bias = mod.w[mod.nr_feature]
-
-    logger.debug("Cleanup")
-    free(param.weight)
-    free(param.weight_label)
-    free(prob.y)
-    for i from 0 <= i < numall:
-        free(prob.x[i])
-    free(prob.x)
-
-    return Model(weights, bias)
-
-cdef inline feature_node *build_feature_node(vector):
+    try:
+        if (prob.y == NULL or prob.x == NULL or nodes == NULL or
+            param.weight == NULL or param.weight_label == NULL):
+            raise MemoryError("Cannot allocate SVM problem for {0} vectors "
+                              "of {1} features".format(numall, numfeat))
+
+        with nogil:
+            for i from 0 <= i < numpos:
+                prob.y[i] = 1
+                prob.x[i] = fill_feature_node(nodes, i, &pos[i, 0], numfeat)
+            for i from 0 <= i < numneg:
+                prob.y[numpos + i] = -1
+                prob.x[numpos + i] = fill_feature_node(nodes, numpos + i,
+                                                       &neg[i, 0], numfeat)
+
+        logger.debug("Constructing parameter")
+        param.solver_type = mach
+        param.eps = eps
+        param.C = c
+        param.nr_weight = 2
+        param.weight[0] = posc
+        param.weight[1] = negc
+        param.weight_label[0] = +1
+        param.weight_label[1] = -1
+
+        logger.debug("Checking parameters")
+        message = <char*> check_parameter(&prob, &param)
+        if message:
+            raise RuntimeError("Error training SVM: " + str(message))
+
+        marshaltime = time.time() - begin
+        begin = time.time()
+
+        logger.info("Optimizing SVM with liblinear")
+        with nogil:
+            mod = liblinear_train(&prob, &param)
+
+        weights = np.empty(mod.nr_feature)
+        memcpy(np.PyArray_DATA(weights), mod.w,
+               mod.nr_feature * sizeof(double))
+        bias = mod.w[mod.nr_feature]
+        optimizetime = time.time() - begin
+    finally:
+        logger.debug("Cleanup")
+        if mod != NULL:
+            destroy_model(mod)
+        free(param.weight)
+        free(param.weight_label)
+        free(prob.y)
+        free(prob.x)
+        free(nodes)
+
+    logger.info("Built SVM problem in {0:.2f} s and optimized it in "
+                "{1:.2f} s".format(marshaltime, optimizetime))
+
+    result = Model(weights, bias)
+    result.marshaltime = marshaltime
+    result.optimizetime = optimizetime
+    return result
+
+def matrix(vectors):
+    """
+    Returns vectors as a C contiguous 2-D float64 matrix, with one vector per
+    row. A matrix that already is one is returned as is.
     """
-    Builds a feature node for a vector. Includes a bias term.
+    if isinstance(vectors, np.ndarray) and vectors.ndim == 2:
+        return np.ascontiguousarray(vectors, dtype = np.double)
+    if len(vectors) == 0:
+        raise ValueError("Need at least one data point")
+    return np.ascontiguousarray(np.vstack(vectors), dtype = np.double)
+
+cdef inline feature_node *fill_feature_node(feature_node *nodes, int row,
+                                            double *vector, int n) nogil:
+    """
+    Fills the feature nodes of one row of a bulk node buffer from a vector
+    and returns a pointer to them. Includes a bias term.
     """
-    cdef np.ndarray[np.double_t, ndim=1] vectort = vector
-    cdef int i, n = vector.size
-    cdef feature_node *nodes
-    nodes = <feature_node*> malloc((n+2)*sizeof(feature_node))
+    cdef int i
+    cdef feature_node *out = nodes + <size_t>row * (n + 2)
 
     for i from 0 <= i < n:
-        nodes[i].index = i + 1
-        nodes[i].value = vectort[i]
-    nodes[n].index = n + 1
-    nodes[n].value = 1
-    nodes[n + 1].index = -1
-    return nodes
+        out[i].index = i + 1
+        out[i].value = vector[i]
+    out[n].index = n + 1
+    out[n].value = 1
+    out[n + 1].index = -1
+    return out
+
+class Incremental(object):
+    """
+    A linear SVM that keeps its examples and its dual solution, so it can be
+    trained again after more examples are added, warm started from where
+    the previous training stopped.
+
+    It solves the same L2-regularized L2-loss problem with a bias that
+    train() solves by default, with the dual coordinate descent of
+    liblinear. The examples added since the last training start with a
+    dual variable of zero, which leaves the weights unchanged, so training
+    again mostly costs passes over what is new.
+
+    >>> learner = Incremental(c = 0.000001)
+    >>> learner.add(positives, negatives)
+    >>> model = learner.train()
+    >>> learner.add(morepositives, morenegatives)
+    >>> model = learner.train()
+    """
+    def __init__(self, float c = 1.0, float eps = 0.01, float posc = 1.0,
+                 float negc = 1.0, int maxiter = 1000):
+        self.c = c
+        self.eps = eps
+        self.posc = posc
+        self.negc = negc
+        self.maxiter = maxiter
+        self.count = 0
+        self.data = None
+        self.labels = None
+        self.alpha = None
+        self.w = None
+
+    def add(self, positives, negatives):
+        """
+        Appends examples, given as train() takes them. Either may be empty.
+        """
+        for vectors, label in [(positives, 1), (negatives, -1)]:
+            if len(vectors) == 0:
+                continue
+            rows = matrix(vectors)
+            if self.data is None:
+                self.data = np.empty((0, rows.shape[1]))
+                self.labels = np.empty(0)
+                self.alpha = np.empty(0)
+                self.w = np.zeros(rows.shape[1] + 1)
+            elif rows.shape[1] != self.data.shape[1]:
+                raise ValueError("Examples have {0} features, but the SVM "
+                                 "has {1}".format(rows.shape[1],
+                                                  self.data.shape[1]))
+            self.reserve(self.count + rows.shape[0])
+            end = self.count + rows.shape[0]
+            self.data[self.count:end] = rows
+            self.labels[self.count:end] = label
+            self.alpha[self.count:end] = 0
+            self.count = end
+
+    def reserve(self, int size):
+        """
+        Grows the storage of the examples to hold at least size of them.
+        """
+        if size <= self.data.shape[0]:
+            return
+        size = max(size, 2 * self.data.shape[0])
+        for name in ["data", "labels", "alpha"]:
+            old = getattr(self, name)
+            new = np.empty((size,) + old.shape[1:])
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def train(self):
+        """
+        Optimizes the dual from the current solution and returns a Model.
+        The number of passes it took is kept in the iterations attribute.
+        """
+        if self.count == 0:
+            raise ValueError("Need at least one data point")
+        if not (self.labels[:self.count] > 0).any():
+            raise ValueError("Need at least one positive data point")
+        if not (self.labels[:self.count] < 0).any():
+            raise ValueError("Need at least one negative data point")
+
+        cdef np.ndarray[np.double_t, ndim=2] data = self.data
+        cdef np.ndarray[np.double_t, ndim=1] labels = self.labels
+        cdef np.ndarray[np.double_t, ndim=1] alpha = self.alpha
+        cdef np.ndarray[np.double_t, ndim=1] w = self.w
+        cdef np.ndarray[np.double_t, ndim=1] diag, qd
+        cdef np.ndarray[np.int32_t, ndim=1] order
+        cdef int l = self.count, n = data.shape[1], iterations
+        cdef int maxiter = self.maxiter
+        cdef double eps = self.eps
+
+        # the diagonal of the dual Hessian that the L2 loss adds, per label
+        diag = np.where(labels[:l] > 0, 0.5 / (self.c * self.posc),
+                        0.5 / (self.c * self.negc))
+        qd = diag + (data[:l] ** 2).sum(axis = 1) + 1
+        order = np.arange(l, dtype = np.int32)
+
+        logger.info("Optimizing SVM over {0} examples from a warm "
+                    "start".format(l))
+        begin = time.time()
+        with nogil:
+            iterations = dualcd(&data[0, 0], &labels[0], &diag[0], &qd[0],
+                                &alpha[0], &w[0], &order[0], l, n, eps,
+                                maxiter)
+        logger.info("Optimized SVM in {0} passes and {1:.2f} s"
+                    .format(iterations, time.time() - begin))
+        if iterations >= maxiter:
+            logger.warning("SVM reached {0} passes without converging"
+                           .format(maxiter))
+
+        result = Model(w[:n].copy(), w[n])
+        result.iterations = iterations
+        return result
+
+    def __len__(self):
+        return self.count
+
+cdef int dualcd(double *data, double *labels, double *diag, double *qd,
+                double *alpha, double *w, np.int32_t *order, int l, int n,
+                double eps, int maxiter) nogil:
+    """
+    Runs dual coordinate descent for the L2-loss linear SVM until the
+    projected gradients span less than eps, updating alpha and w, which
+    holds the weights with the bias last, in place. Every example has an
+    implicit last feature of 1 for the bias, and qd holds the diagonal of
+    the dual Hessian. Returns the number of passes.
+
+    As in liblinear, examples at zero whose gradient is beyond the largest
+    projected gradient of the previous pass are shrunk out of the active
+    set, and convergence is checked again over every example.
+    """
+    cdef int iteration = 0, active = l, s, i, j, k
+    cdef double g, pg, pgmax, pgmin, old, yi
+    cdef double pgmaxold = 1e300
+    cdef double *x
+
+    while iteration < maxiter:
+        for s from 0 <= s < active:
+            j = s + rand() % (active - s)
+            k = order[s]
+            order[s] = order[j]
+            order[j] = k
+
+        pgmax = -1e300
+        pgmin = 1e300
+        s = 0
+        while s < active:
+            i = order[s]
+            x = data + <size_t>i * n
+            yi = labels[i]
+
+            g = w[n]
+            for k from 0 <= k < n:
+                g += w[k] * x[k]
+            g = yi * g - 1 + diag[i] * alpha[i]
+
+            pg = g
+            if alpha[i] == 0:
+                if g > pgmaxold:
+                    active -= 1
+                    order[s] = order[active]
+                    order[active] = i
+                    continue
+                elif g > 0:
+                    pg = 0
+            if pg > pgmax:
+                pgmax = pg
+            if pg < pgmin:
+                pgmin = pg
+
+            if pg > 1e-12 or pg < -1e-12:
+                old = alpha[i]
+                alpha[i] = old - g / qd[i]
+                if alpha[i] < 0:
+                    alpha[i] = 0
+                old = (alpha[i] - old) * yi
+                for k from 0 <= k < n:
+                    w[k] += old * x[k]
+                w[n] += old
+            s += 1
+
+        iteration += 1
+        if pgmax - pgmin <= eps:
+            if active == l:
+                break
+            active = l
+            pgmaxold = 1e300
+            continue
+        pgmaxold = pgmax
+        if pgmaxold <= 0:
+            pgmaxold = 1e300
+    return iteration
@@ -4,8 +4,13 @@ from vision import Box
 from vision.track import pairwise
 from vision import annotations
 from vision.model import PathModel
+from vision.model import scoreframes
+from vision.pyramid import PyramidCache
+from vision.sharedmem import SharedFrames, SharedCosts
 
 from math import ceil
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 import logging
 
@@ -21,7 +26,9 @@ logger = logging.getLogger("vision.track.dp")
 
 def fill(givens, images, last = None, 
          pairwisecost = 0.001, upperthreshold = 10, lowerthreshold = -100,
-         skip = 3, rgbbin = 8, hogbin = 8, c = 1, realprior = None, pool = None):
+         skip = 3, rgbbin = 8, hogbin = 8, c = 1, realprior = None, pool = None,
+         pyramids = None, compact = False, checkpoint = None, shared = False,
+         threads = None):
 
     givens.sort(key = lambda x: x.frame)
 
@@ -31,27 +38,121 @@ def fill(givens, images, last = None,
     fullpath = []
     for x, y in zip(givens, givens[1:]):
         path = track(x, y, model, images, pairwisecost,
-                    upperthreshold, lowerthreshold, skip, pool)
+                    upperthreshold, lowerthreshold, skip, pool, pyramids,
+                    compact, checkpoint, shared = shared,
+                    threads = threads)
         fullpath.extend(path[:-1])
 
     if last is not None and last > givens[-1].frame:
         path = track(givens[-1], last, model, images,
-                     pairwisecost, upperthreshold, lowerthreshold, skip, pool)
+                     pairwisecost, upperthreshold, lowerthreshold, skip, pool,
+                     pyramids, compact, checkpoint, shared = shared,
+                     threads = threads)
         fullpath.extend(path[:-1])
 
     return fullpath
 
+def fillmany(givens, images, lasts = None,
+             pairwisecost = 0.001, upperthreshold = 10, lowerthreshold = -100,
+             skip = 3, rgbbin = 8, hogbin = 8, c = 1, pool = None,
+             pyramids = None, window = 30):
+    """
+    Fills many paths through the same video, as fill() does for one. givens
+    maps each path to its given boxes and lasts, if given, maps a path to the
+    frame to track it to after its last given box. Returns the filled paths
+    under the same keys.
+
+    Every frame is scored once for all the paths through it with scoremany(),
+    so models that resize the frame alike share its features. Without
+    pyramids that only happens for boxes of the same size; with pyramids,
+    boxes that fall on the same level share it.
+
+    Frames are scored in order, window frames at a time, and each segment is
+    tracked and its cost maps dropped as soon as its last frame is scored.
+    So only the cost maps of the segments that overlap the window are held
+    at once, rather than those of the whole video.
+    """
+    if lasts is None:
+        lasts = {}
+
+    segments = []
+    for id, boxes in givens.items():
+        boxes.sort(key = lambda x: x.frame)
+        model = PathModel(images, boxes, rgbbin = rgbbin, hogbin = hogbin,
+                          c = c)
+        for x, y in zip(boxes, boxes[1:]):
+            segments.append((id, x, y, y.frame, model))
+        last = lasts.get(id)
+        if last is not None and last > boxes[-1].frame:
+            segments.append((id, boxes[-1], last, last, model))
+    # the sort is stable, so the segments of a path stay in order
+    segments.sort(key = lambda x: x[1].frame)
+
+    members = {}
+    for index, (_, start, _, stopframe, _) in enumerate(segments):
+        for frame in range(start.frame, stopframe + 1):
+            members.setdefault(frame, []).append(index)
+    frames = sorted(members)
+
+    logger.info("Scoring {0} frames for {1} segments".format(len(frames),
+                                                             len(segments)))
+    mapper = pool.map if pool else map
+    costs = {}
+    pieces = {}
+    for i in range(0, len(frames), window):
+        chunk = frames[i:i + window]
+        orders = [(images, frame,
+                   [segments[x][1] for x in members[frame]],
+                   [segments[x][4] for x in members[frame]], pyramids)
+                  for frame in chunk]
+        for frame, framecosts in mapper(scoremany, orders):
+            for index, cost in zip(members[frame], framecosts):
+                costs.setdefault(index, {})[frame] = cost
+
+        finished = [x for x in costs if segments[x][3] <= chunk[-1]]
+        for index in sorted(finished):
+            id, start, stop, _, model = segments[index]
+            path = track(start, stop, model, images, pairwisecost,
+                         upperthreshold, lowerthreshold, skip,
+                         pyramids = pyramids, costs = costs.pop(index))
+            pieces[index] = path[:-1]
+
+    paths = dict((id, []) for id in givens)
+    for index, segment in enumerate(segments):
+        paths[segment[0]].extend(pieces[index])
+    return paths
+
 def track(start, stop, model, images,
           pairwisecost = 0.001, upperthreshold = 10, lowerthreshold = -100,
-          skip = 3, pool = None):
+          skip = 3, pool = None, pyramids = None, compact = False,
+          checkpoint = None, coarse = None, band = None, shared = False,
+          threads = None, costs = None, shrink = 4):
+    """
+    Tracks start to stop, which is either a box or just a frame.
+
+    If coarse is given, the dynamic program is first solved on a grid with
+    that many pixels between cells, and then solved at skip only inside a
+    band of band pixels around the coarse path (by default twice coarse).
+    The pairwise cost is scaled to the coarse grid, so callables must have
+    a scaled() method, as the costs in pairwise do. The coarse pass scores
+    frames shrink times smaller with the model's scoreshrunk(), and the
+    refined pass only scores the crop of each frame around its band with
+    scoreregion(), so neither scores the full frame at full size. Scoring
+    in coarse mode does not use pyramids or shared.
+
+    If shared and there is a pool, frames and cost maps travel to and from
+    the workers through shared memory instead of being pickled.
+
+    If threads is given and there is no pool, frames are scored by that many
+    threads in this process, sharing the frames and the model without
+    copies. The scoring kernels release the GIL, so the threads overlap.
+
+    If costs is given, it maps every frame to its cost map for the size of
+    start, as scoreframe() returns, and the frames are not scored again.
+    """
 
     imagesize = images[start.frame].size
 
-    if pool:
-        mapper = pool.map
-    else:
-        mapper = map
-
     try:
         stopframe = stop.frame
         constrained = True
@@ -79,24 +180,172 @@ def track(start, stop, model, images,
 
     # build dictionary of local scores
     # if there is a pool, this will happen in parallel
-    logger.info("Scoring frames")
-    orders = [(images, start, x, model) for x in frames]
-    costs = dict(mapper(scoreframe, orders))
-
-    # forward and backwards passes
-    # if there is a pool, this will use up to 2 cores
-    forwardsargs  = [frames, imagesize, model, costs, pairwisecost,
-                     upperthreshold, lowerthreshold, skip, constraints]
-    logger.info("Building forwards graph")
-    forwards  = buildgraph(*forwardsargs)
-    
-    # backtrack
+    threadpool = None
+    if pool:
+        mapper = pool.map
+    elif threads:
+        threadpool = ThreadPool(threads)
+        mapper = threadpool.map
+    else:
+        mapper = map
+    try:
+        if costs is None and not coarse:
+            logger.info("Scoring frames")
+            if pool and shared:
+                costs = scoreshared(pool, images, start, frames, model,
+                                    pyramids)
+            else:
+                orders = [(images, start, x, model, pyramids) for x in frames]
+                costs = dict(mapper(scoreframe, orders))
+
+        if coarse:
+            if costs is None:
+                logger.info("Scoring frames at 1/{0} size".format(shrink))
+                orders = [(images, start, x, model, shrink) for x in frames]
+                coarsecosts = dict(mapper(scoreshrunk, orders))
+            else:
+                coarsecosts = costs
+
+            logger.info("Building coarse graph")
+            # keep the penalty per pixel the same on the coarser grid
+            factor = coarse / float(skip)
+            if not callable(pairwisecost):
+                coarsecost = pairwisecost * factor ** 2
+            elif hasattr(pairwisecost, "scaled"):
+                coarsecost = pairwisecost.scaled(factor)
+            else:
+                raise ValueError("Pairwise cost {0} cannot be scaled to the "
+                                 "coarse grid".format(pairwisecost))
+            forwards = buildgraph(frames, imagesize, model, coarsecosts,
+                                  coarsecost, upperthreshold, lowerthreshold,
+                                  coarse, constraints, compact, checkpoint)
+            coarsepath = backtrack(forwards, start, stop, stopframe, coarse,
+                                   constrained)
+            del forwards, coarsecosts
+
+            if band is None:
+                band = 2 * coarse
+            windows = bands(coarsepath, imagesize, start, constraints, skip,
+                            band)
+            if costs is None:
+                logger.info("Scoring frames inside the band")
+                orders = [(images, start, x, model,
+                           (windows[x][0] * skip, windows[x][1] * skip,
+                            (windows[x][2] - 1) * skip + 1,
+                            (windows[x][3] - 1) * skip + 1))
+                          for x in frames]
+                costs = dict(mapper(scoreregion, orders))
+
+            logger.info("Building refined graph")
+            forwards = buildband(frames, imagesize, model, costs,
+                                 pairwisecost, upperthreshold,
+                                 lowerthreshold, skip, constraints, windows)
+        else:
+            # forward and backwards passes
+            # if there is a pool, this will use up to 2 cores
+            forwardsargs  = [frames, imagesize, model, costs, pairwisecost,
+                             upperthreshold, lowerthreshold, skip,
+                             constraints, compact, checkpoint]
+            logger.info("Building forwards graph")
+            forwards  = buildgraph(*forwardsargs)
+    finally:
+        if threadpool is not None:
+            threadpool.close()
+            threadpool.join()
+
     logger.info("Backtracking")
+    return backtrack(forwards, start, stop, stopframe, skip, constrained)
+
+def stream(start, frames, model, lag = 30, pairwisecost = 0.001,
+           upperthreshold = 10, lowerthreshold = -100, skip = 3):
+    """
+    Tracks start forward through a stream of frames and yields each box once
+    it is committed, lag frames behind the newest frame.
+
+    frames is any iterable of the images that follow start, one per frame,
+    such as itertools.islice(iter(video), start.frame + 1, None) over a
+    frameiterator or ffmpeg.extract. Only the pointers of the last lag
+    frames are kept, so memory stays constant however long the stream is.
+    A box is committed by backtracking from the cheapest cell of the newest
+    frame, so it only has lag frames of hindsight, unlike track(). When the
+    stream ends, the remaining boxes are committed from its last frame.
+    """
+    cdef double wr, hr
+    cdef int usablewidth, usableheight
+
+    wr = model.dim[0] / (<double>start.width)
+    hr = model.dim[1] / (<double>start.height)
+    transform = pairwise.distance(pairwisecost)
+
+    logger.info("Streaming from {0} with a lag of {1}".format(start.frame,
+                                                              lag))
+
+    yield start
+
+    frame = start.frame
+    current = None
+    pointers = deque()
+    for image in frames:
+        frame += 1
+        if current is None:
+            width, height = image.size
+            usablewidth = <int>ceil((width - start.width) / <double>(skip))
+            usableheight = <int>ceil((height - start.height) / <double>(skip))
+            grid = unarygrid((usablewidth, usableheight), wr, hr, skip)
+            current = numpy.empty((usablewidth, usableheight))
+            current.fill(1e200)
+            current[start.xtl // skip, start.ytl // skip] = 0
+
+        cost = model.scoreframe(image, start.size, frame)
+        current, xpointer, ypointer = transform(current)
+        unary(current, cost, grid, upperthreshold, lowerthreshold)
+        # only differences matter, so keep the costs from growing forever
+        current -= current.min()
+        pointers.append((xpointer, ypointer))
+
+        if len(pointers) > lag:
+            # the oldest pointers lead into a frame already committed
+            pointers.popleft()
+            x, y = streamback(current, pointers)
+            yield annotations.Box(x * skip, y * skip,
+                                  x * skip + start.width,
+                                  y * skip + start.height,
+                                  frame - lag)
+
+    if current is None:
+        return
+
+    # commit the boxes still waiting, from the last frame of the stream
+    x, y = numpy.unravel_index(numpy.argmin(current), current.shape)
+    path = []
+    for offset, (xpointer, ypointer) in enumerate(reversed(pointers)):
+        path.append(annotations.Box(x * skip, y * skip,
+                                    x * skip + start.width,
+                                    y * skip + start.height,
+                                    frame - offset))
+        x, y = xpointer[x, y], ypointer[x, y]
+    for box in reversed(path):
+        yield box
+
+def streamback(current, pointers):
+    """
+    Follows the pointers back from the cheapest cell of the newest frame and
+    returns the cell they lead to, lag frames behind it.
+    """
+    x, y = numpy.unravel_index(numpy.argmin(current), current.shape)
+    for xpointer, ypointer in reversed(pointers):
+        x, y = xpointer[x, y], ypointer[x, y]
+    return x, y
+
+def backtrack(forwards, start, stop, stopframe, int skip, constrained):
+    """
+    Follows the pointers of a graph back from the stop box, or from the
+    cheapest cell of the stop frame if the track is not constrained.
+    """
     if constrained:
         x, y, frame = stop.xtl, stop.ytl, stop.frame
     else:
-        x, y = numpy.unravel_index(numpy.argmin(forwards[stopframe][0]),
-                                                forwards[stopframe][0].shape)
+        x, y = forwards.best(stopframe)
         x = x * skip
         y = y * skip
         frame = stopframe
@@ -106,23 +355,243 @@ def track(start, stop, model, images,
                                     x + start.width,
                                     y + start.height,
                                     frame))
-        x, y = (forwards[frame][1][x // skip, y // skip] * skip,
-                forwards[frame][2][x // skip, y // skip] * skip)
+        x, y = forwards.pointer(frame, x // skip, y // skip)
+        x, y = x * skip, y * skip
         frame = frame - 1
     path.append(start)
     path.reverse()
     return path
 
-def buildgraph(frames, imagesize, model, costs,
-               double pairwisecost, double upperthreshold, 
-               double lowerthreshold, int skip, constraints):
+def bands(path, imagesize, start, constraints, int skip, int band):
+    """
+    Returns the window of cells at skip within band pixels of each box of a
+    path, keyed by frame, as (xtl, ytl, xbr, ybr) with exclusive ends.
+    """
+    width, height = imagesize
+    usablewidth = <int>ceil((width - start.width) / <double>(skip))
+    usableheight = <int>ceil((height - start.height) / <double>(skip))
+    windows = {}
+    for box in path:
+        windows[box.frame] = (max((box.xtl - band) // skip, 0),
+                              max((box.ytl - band) // skip, 0),
+                              min((box.xtl + band) // skip + 1, usablewidth),
+                              min((box.ytl + band) // skip + 1, usableheight))
+    for constraint in constraints:
+        xtl, ytl, xbr, ybr = windows[constraint.frame]
+        x, y = constraint.xtl // skip, constraint.ytl // skip
+        windows[constraint.frame] = (min(xtl, x), min(ytl, y),
+                                     max(xbr, x + 1), max(ybr, y + 1))
+    return windows
 
-    cdef double cost, wr, hr
+def buildgraph(frames, imagesize, model, costs,
+               pairwisecost, double upperthreshold, 
+               double lowerthreshold, int skip, constraints,
+               compact = False, checkpoint = None, dtype = numpy.double):
+    """
+    Runs the dynamic program over frames and returns a Graph keyed by frame.
+
+    By default every frame stores its cost map and both pointer maps. In
+    compact mode the pointers are packed into one small integer per cell,
+    and if checkpoint is given, only every checkpoint-th frame keeps its
+    costs while pointers are recomputed from the nearest checkpoint during
+    backtracking, so memory no longer grows with the full cost history.
+
+    The costs are always computed in double precision and only stored as
+    dtype, so float32 halves the memory of the messages but not the work of
+    the recursion. The recursion is min-sum, so the messages are already
+    negative log max-marginals and need no log-sum-exp. Costs that are too
+    large for dtype, such as those of cells ruled out by a constraint, are
+    kept as infinity.
+    """
+    cdef double wr, hr
     cdef int width, height, usablewidth, usableheight
-    cdef numpy.ndarray[numpy.double_t, ndim=2] relevantcosts
+    cdef annotations.Box start = constraints[0]
+
+    width, height = imagesize
+    wr = model.dim[0] / (<double>start.width)
+    hr = model.dim[1] / (<double>start.height)
+    usablewidth = <int>ceil((width - start.width) / <double>(skip))
+    usableheight = <int>ceil((height - start.height) / <double>(skip))
+
+    grid = unarygrid((usablewidth, usableheight), wr, hr, skip)
+    step = (costs, pairwise.distance(pairwisecost), grid, upperthreshold,
+            lowerthreshold, skip, constraints)
+    graph = Graph(frames, (usablewidth, usableheight), step, compact,
+                  checkpoint, dtype)
+
+    current = None
+    for index, frame in enumerate(graph.frames):
+        current, xpointer, ypointer = advance(current, frame, graph.shape,
+                                              *step)
+        graph.store(index, frame, current, xpointer, ypointer)
+    return graph
+
+def advance(previous, frame, shape, costs, transform, grid,
+            double upperthreshold, double lowerthreshold, int skip,
+            constraints):
+    """
+    Advances the dynamic program by one frame from the costs of the previous
+    frame, or from nothing on the first frame.
+    """
+    cdef int usablewidth, usableheight
     cdef numpy.ndarray[numpy.double_t, ndim=2] current
-    cdef numpy.ndarray[numpy.int_t, ndim=2] xpointer, ypointer
     cdef annotations.Box constraint
+
+    cdef double Huge = 1e200
+
+    usablewidth, usableheight = shape
+
+    if previous is None:
+        current = numpy.zeros((usablewidth, usableheight),
+                               dtype = numpy.double)
+        xpointer = None
+        ypointer = None
+    else:
+        current, xpointer, ypointer = transform(previous)
+
+    for constraint in constraints:
+        if constraint.frame == frame:
+            current = numpy.ones((usablewidth, usableheight),
+                                  dtype = numpy.double)
+            current = current * Huge
+            current[constraint.xtl // skip, constraint.ytl // skip] = 0
+            break
+    else:
+        unary(current, costs[frame], grid, upperthreshold, lowerthreshold)
+
+    return current, xpointer, ypointer
+
+def unarygrid(shape, double wr, double hr, int skip):
+    """
+    Returns the index into the cost map of a frame for every cell of the
+    graph, computed once for a whole segment.
+    """
+    xs = (numpy.arange(shape[0]) * wr * skip).astype(numpy.int)
+    ys = (numpy.arange(shape[1]) * hr * skip).astype(numpy.int)
+    return numpy.ix_(xs, ys)
+
+def unary(current, relevantcosts, grid, double upperthreshold,
+          double lowerthreshold):
+    """
+    Adds the thresholded costs of a frame to every cell of the graph.
+    """
+    cost = relevantcosts[grid]
+    numpy.minimum(cost, upperthreshold, cost)
+    numpy.maximum(cost, lowerthreshold, cost)
+    current += cost
+
+def unaryreference(numpy.ndarray[numpy.double_t, ndim=2] current,
+                   numpy.ndarray[numpy.double_t, ndim=2] relevantcosts,
+                   double wr, double hr, int skip, double upperthreshold,
+                   double lowerthreshold):
+    """
+    Adds the thresholded costs of a frame one cell at a time. This is the
+    original loop, kept to check unary() against.
+    """
+    cdef double cost
+    for x in range(0, current.shape[0]):
+        for y in range(0, current.shape[1]):
+            cost  = relevantcosts[<int>(x*wr*skip), <int>(y*hr*skip)]
+            cost  = min(cost, upperthreshold)
+            cost  = max(cost, lowerthreshold)
+            current[x, y] += cost
+
+class Graph(dict):
+    """
+    The result of a pass of the dynamic program, keyed by frame.
+
+    In the default layout each frame holds (costs, xpointer, ypointer). In
+    compact mode each frame holds (costs, pointers) where a pointer packs
+    both coordinates as x * height + y, and either item may be None if it
+    was not kept. Use pointer() to backtrack through either layout.
+    """
+    def __init__(self, frames, shape, step, compact = False,
+                 checkpoint = None, dtype = numpy.double):
+        self.frames = list(frames)
+        self.shape = shape
+        self.compact = compact or checkpoint is not None
+        self.checkpoint = checkpoint
+        self.step = step if checkpoint is not None else None
+        self.segment = {}
+        self.dtype = dtype
+
+        if shape[0] * shape[1] <= 2**16:
+            self.pointertype = numpy.uint16
+        else:
+            self.pointertype = numpy.int32
+
+    def store(self, index, frame, current, xpointer, ypointer):
+        if current.dtype != self.dtype:
+            with numpy.errstate(over = "ignore"):
+                current = current.astype(self.dtype)
+        if not self.compact:
+            self[frame] = current, xpointer, ypointer
+            return
+        if self.checkpoint is not None:
+            if index % self.checkpoint and index < len(self.frames) - 1:
+                current = None
+            self[frame] = current, None
+        else:
+            self[frame] = current, self.pack(xpointer, ypointer)
+
+    def pack(self, xpointer, ypointer):
+        if xpointer is None:
+            return None
+        return (xpointer * self.shape[1] + ypointer).astype(self.pointertype)
+
+    def best(self, frame):
+        """
+        Returns the cheapest cell of a frame.
+        """
+        return numpy.unravel_index(numpy.argmin(self[frame][0]),
+                                   self[frame][0].shape)
+
+    def pointer(self, frame, x, y):
+        """
+        Returns the cell in the previous frame that leads to cell (x, y) of a
+        frame.
+        """
+        if not self.compact:
+            return self[frame][1][x, y], self[frame][2][x, y]
+        pointers = self[frame][1]
+        if pointers is None:
+            pointers = self.recompute(frame)
+        return divmod(int(pointers[x, y]), self.shape[1])
+
+    def recompute(self, frame):
+        """
+        Replays the segment that holds a frame from its checkpoint and keeps
+        the pointers of that segment only.
+        """
+        if frame not in self.segment:
+            index = self.frames.index(frame)
+            first = index - 1
+            while self[self.frames[first]][0] is None:
+                first -= 1
+            last = min(first + self.checkpoint, len(self.frames) - 1)
+            logger.debug("Recomputing frames {0} to {1}".format(
+                         self.frames[first + 1], self.frames[last]))
+            self.segment = {}
+            # ruled out cells come back as infinity from a small dtype
+            current = numpy.minimum(self[self.frames[first]][0], 1e200)
+            current = current.astype(numpy.double)
+            for other in self.frames[first + 1:last + 1]:
+                current, xpointer, ypointer = advance(current, other,
+                                                      self.shape, *self.step)
+                self.segment[other] = self.pack(xpointer, ypointer)
+        return self.segment[frame]
+
+def buildband(frames, imagesize, model, costs,
+              pairwisecost, double upperthreshold,
+              double lowerthreshold, int skip, constraints, windows):
+    """
+    Runs the dynamic program only over a window of cells in every frame, as
+    returned by bands(). The distance transform of each frame spans just the
+    windows of that frame and the one before it, so the work depends on the
+    size of the band rather than the image.
+    """
+    cdef double wr, hr
+    cdef int width, height, usablewidth, usableheight
     cdef annotations.Box start = constraints[0]
 
     cdef double Huge = 1e200
@@ -133,55 +602,104 @@ def buildgraph(frames, imagesize, model, costs,
     usablewidth = <int>ceil((width - start.width) / <double>(skip))
     usableheight = <int>ceil((height - start.height) / <double>(skip))
 
-    graph = {}
+    xs, ys = unarygrid((usablewidth, usableheight), wr, hr, skip)
+    transform = pairwise.distance(pairwisecost)
+    graph = BandGraph(windows)
 
-    # walk along linear path
+    current = None
     for frame in frames:
-        if frame == frames[0]:
-            current = numpy.zeros((usablewidth, usableheight),
-                                   dtype = numpy.double)
-            xpointer = None
-            ypointer = None
+        xtl, ytl, xbr, ybr = window = windows[frame]
+        if current is None:
+            current = numpy.zeros((xbr - xtl, ybr - ytl))
+            xpointer, ypointer = None, None
         else:
-            current, xpointer, ypointer = pairwise.quadratic(current,
-                                                             pairwisecost)
+            # transform over the union of both windows, then keep this one
+            uxtl, uytl = min(xtl, last[0]), min(ytl, last[1])
+            uxbr, uybr = max(xbr, last[2]), max(ybr, last[3])
+            union = numpy.empty((uxbr - uxtl, uybr - uytl))
+            union.fill(Huge)
+            union[last[0] - uxtl:last[2] - uxtl,
+                  last[1] - uytl:last[3] - uytl] = current
+            current, xpointer, ypointer = transform(union)
+            keep = (slice(xtl - uxtl, xbr - uxtl),
+                    slice(ytl - uytl, ybr - uytl))
+            current = numpy.ascontiguousarray(current[keep])
+            xpointer = xpointer[keep] + uxtl
+            ypointer = ypointer[keep] + uytl
 
         for constraint in constraints:
             if constraint.frame == frame:
-                current = numpy.ones((usablewidth, usableheight),
-                                      dtype = numpy.double)
-                current = current * Huge
-                #print "image", width, height
-                #print "usable", usablewidth, usableheight
-                #print "constraint", constraint.xtl, constraint.ytl, constraint
-                #print "start", start.width, start.height, str(start)
-                #print "ratio", wr, hr
-                #print "skip", skip
-                current[constraint.xtl // skip, constraint.ytl // skip] = 0
+                current = numpy.empty((xbr - xtl, ybr - ytl))
+                current.fill(Huge)
+                current[constraint.xtl // skip - xtl,
+                        constraint.ytl // skip - ytl] = 0
                 break
         else:
-            relevantcosts = costs[frame]
-
-            for x in range(0, usablewidth):
-                for y in range(0, usableheight):
-                    cost  = relevantcosts[<int>(x*wr*skip), <int>(y*hr*skip)]
-                    cost  = min(cost, upperthreshold)
-                    cost  = max(cost, lowerthreshold)
-                    current[x, y] += cost
+            unary(current, costs[frame], (xs[xtl:xbr], ys[:, ytl:ybr]),
+                  upperthreshold, lowerthreshold)
 
         graph[frame] = current, xpointer, ypointer
+        last = window
     return graph
 
+class BandGraph(dict):
+    """
+    The result of buildband(), keyed by frame. Each frame holds (costs,
+    xpointer, ypointer) over its window only, with pointers to absolute
+    cells.
+    """
+    def __init__(self, windows):
+        self.windows = windows
+
+    def best(self, frame):
+        x, y = numpy.unravel_index(numpy.argmin(self[frame][0]),
+                                   self[frame][0].shape)
+        return x + self.windows[frame][0], y + self.windows[frame][1]
+
+    def pointer(self, frame, x, y):
+        xtl, ytl = self.windows[frame][0:2]
+        return (self[frame][1][x - xtl, y - ytl],
+                self[frame][2][x - xtl, y - ytl])
+
+def scoreshared(pool, images, start, frames, model, pyramids = None):
+    """
+    Scores frames in a pool, sharing the decoded frames and the resulting
+    cost maps with the workers through memory mapped files. The workers
+    decode the frames into the shared buffer themselves. Returns the cost
+    maps keyed by frame.
+    """
+    with SharedFrames(images, frames) as sharedframes:
+        with SharedCosts() as results:
+            if pyramids is not None:
+                pyramids = PyramidCache(sharedframes, pyramids.sbin,
+                                        pyramids.interval, pyramids.capacity)
+            orders = [(sharedframes, start, x, model, pyramids, results)
+                      for x in frames]
+            pool.map(scoreframe, orders)
+            # the maps stay readable after their files are removed
+            return dict((x, results[x]) for x in frames)
+
 def scoreframe(workorder):
     """
     Convolves a learned weight vector against an image. This method
     should take a workorder tuple because it can be used in multiprocessing.
+
+    The workorder may carry a fifth item with a cache of feature pyramids to
+    share features with other models scoring the same frame, and a sixth
+    with shared costs to put the cost map in instead of returning it.
     """
-    images, start, frame, model = workorder
+    images, start, frame, model = workorder[:4]
+    pyramids = workorder[4] if len(workorder) > 4 else None
+    results = workorder[5] if len(workorder) > 5 else None
 
     logger.debug("Scoring frame {0}".format(frame))
 
-    cost = model.scoreframe(images[frame], start.size, frame)
+    if pyramids is not None:
+        pyramid = pyramids[frame]
+        cost = model.scoreframe(pyramid.image, start.size, frame,
+                                pyramid = pyramid)
+    else:
+        cost = model.scoreframe(images[frame], start.size, frame)
 
     if debug:
         pylab.set_cmap("gray")
@@ -190,4 +708,46 @@ def scoreframe(workorder):
         pylab.savefig("tmp/cost{0}.png".format(frame))
         pylab.clf()
 
+    if results is not None:
+        return results.put(frame, cost), None
     return frame, cost
+
+def scoreshrunk(workorder):
+    """
+    Convolves a learned weight vector against an image shrunk by a factor,
+    for the coarse pass of track(). The workorder holds the images, the
+    start box, the frame, the model and the factor.
+    """
+    images, start, frame, model, shrink = workorder
+    logger.debug("Scoring frame {0} at 1/{1} size".format(frame, shrink))
+    return frame, model.scoreshrunk(images[frame], start.size, shrink, frame)
+
+def scoreregion(workorder):
+    """
+    Convolves a learned weight vector against the crop of an image around a
+    region, for the refined pass of track(). The workorder holds the images,
+    the start box, the frame, the model and the region.
+    """
+    images, start, frame, model, region = workorder
+    logger.debug("Scoring frame {0} in {1}".format(frame, region))
+    return frame, model.scoreregion(images[frame], start.size, region, frame)
+
+def scoremany(workorder):
+    """
+    Convolves several learned weight vectors against the same frame in one
+    pass, such as many paths tracked through one video. The workorder holds
+    the images, the frame, parallel lists of the start boxes and models, and
+    optionally a cache of feature pyramids.
+    """
+    images, frame, starts, models = workorder[:4]
+    pyramids = workorder[4] if len(workorder) > 4 else None
+
+    logger.debug("Scoring frame {0} for {1} models".format(frame, len(models)))
+
+    sizes = [start.size for start in starts]
+    if pyramids is not None:
+        pyramid = pyramids[frame]
+        costs = scoreframes(models, pyramid.image, sizes, frame, pyramid)
+    else:
+        costs = scoreframes(models, images[frame], sizes, frame)
+    return frame, costs
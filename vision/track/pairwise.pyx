@@ -1,35 +1,45 @@
+"""
+Generalized distance transforms for the pairwise costs of the trackers.
+
+Every transform takes a (width, height) map of scores and returns the
+transformed scores together with the x and y pointers to the location that
+produced each minimum, so they can be used interchangeably by
+dp.buildgraph. The transforms are separable and take linear time in the
+size of the map, regardless of the cost or radius.
+
+>>> M, Ix, Iy = Quadratic(0.001)(scores)
+>>> M, Ix, Iy = Hinge(radius = 30)(scores)
+"""
+
 import numpy
 cimport numpy
+from math import ceil
 
 cdef double Infinity = 1e300
 
 cdef extern from "math.h":
     float exp(float n)
 
+cdef enum:
+    QUADRATIC, MANHATTAN, HINGE
+
 # see Pedro Felzenszwalb et. al
-cpdef quadratic_1d(numpy.ndarray[numpy.double_t, ndim=1] src,
-                            numpy.ndarray[numpy.double_t, ndim=1] dst,
-                            numpy.ndarray[numpy.int_t, ndim=1] ptr,
-                            int step, int n, double a, double b, int o):
-    
-    cdef numpy.ndarray[numpy.int_t, ndim=1] v = numpy.zeros(n, dtype=numpy.int)
-    cdef numpy.ndarray[numpy.double_t, ndim=1] z = numpy.zeros(n+1,
-                                                   dtype = numpy.double)
-    cdef int k = 0
+cdef void quadratic_kernel(double *src, double *dst, long *ptr,
+                           long *v, double *z,
+                           int step, int n, double a, double b) nogil:
+    cdef int k = 0, q
+    cdef double s
     v[0] = 0
     z[0] = -Infinity
     z[1] = Infinity
 
-    cdef int q
-    cdef double s
-
     for q in range(1, n):
-        s = ((src[q*step+o]-src[v[k]*step+o])-b*(q-v[k])+a*(q**2-v[k]**2))
+        s = ((src[q*step]-src[v[k]*step])-b*(q-v[k])+a*(q*q-v[k]*v[k]))
         s = s / (2*a*(q-v[k]))
 
         while s <= z[k]:
             k = k - 1
-            s = ((src[q*step+o]-src[v[k]*step+o])-b*(q-v[k])+a*(q**2-v[k]**2))
+            s = ((src[q*step]-src[v[k]*step])-b*(q-v[k])+a*(q*q-v[k]*v[k]))
             s = s / (2*a*(q-v[k]))
 
         k = k + 1
@@ -41,141 +51,216 @@ cpdef quadratic_1d(numpy.ndarray[numpy.double_t, ndim=1] src,
     for q in range(0, n):
         while z[k+1] < q:
             k = k + 1
-        dst[q*step+o] = a*(q-v[k])**2 + b*(q-v[k]) + src[v[k]*step+o]
-        ptr[q*step+o] = v[k]
+        dst[q*step] = a*(q-v[k])*(q-v[k]) + b*(q-v[k]) + src[v[k]*step]
+        ptr[q*step] = v[k]
 
-# see Pedro Felzenszwalb et. al
-def quadratic(numpy.ndarray[numpy.double_t, ndim=2] scores,
-                       double cost):
-    cdef int w, h, x, y, p
-    w = scores.shape[0]
-    h = scores.shape[1]
+cdef void manhattan_kernel(double *src, double *dst, long *ptr,
+                           int step, int n, double a) nogil:
+    cdef int q
+    # sweep forwards, then backwards, carrying the cheapest source along
+    for q in range(0, n):
+        dst[q*step] = src[q*step]
+        ptr[q*step] = q
+        if q > 0 and dst[(q-1)*step] + a < dst[q*step]:
+            dst[q*step] = dst[(q-1)*step] + a
+            ptr[q*step] = ptr[(q-1)*step]
+    for q in range(n - 2, -1, -1):
+        if dst[(q+1)*step] + a < dst[q*step]:
+            dst[q*step] = dst[(q+1)*step] + a
+            ptr[q*step] = ptr[(q+1)*step]
+
+cdef void hinge_kernel(double *src, double *dst, long *ptr, long *queue,
+                       int step, int n, int radius) nogil:
+    # sliding window minimum over [q - radius, q + radius) with a monotonic
+    # queue of candidates, keeping the earliest of equal scores at the front
+    cdef int head = 0, tail = 0, q, best
+    cdef int stop = 0
+    for q in range(0, n):
+        while stop < n and stop < q + radius:
+            while tail > head and src[queue[tail-1]*step] > src[stop*step]:
+                tail = tail - 1
+            queue[tail] = stop
+            tail = tail + 1
+            stop = stop + 1
+        while head < tail and queue[head] < q - radius:
+            head = head + 1
+        # staying put wins ties, as in the original scan
+        best = q
+        if head < tail and src[queue[head]*step] < src[q*step]:
+            best = queue[head]
+        dst[q*step] = src[best*step]
+        ptr[q*step] = best
 
-    cdef numpy.ndarray[numpy.double_t, ndim=1] vals = scores.flatten()
+cdef separable(numpy.ndarray[numpy.double_t, ndim=2] scores, int kind,
+               double xcost, double ycost, int radius):
+    """
+    Applies a 1-D transform down every column and then along every row.
+    """
+    cdef int w = scores.shape[0], h = scores.shape[1], x, y
+    cdef int n = max(w, h)
 
-    cdef numpy.ndarray[numpy.double_t, ndim=1] M = numpy.zeros(w*h, 
-                                                   dtype = numpy.double)
-    cdef numpy.ndarray[numpy.int_t, ndim=2] Ix = numpy.zeros((w, h), 
+    cdef numpy.ndarray[numpy.double_t, ndim=2] src
+    src = numpy.ascontiguousarray(scores, dtype = numpy.double)
+    cdef numpy.ndarray[numpy.double_t, ndim=2] tmpM = numpy.empty((w, h))
+    cdef numpy.ndarray[numpy.double_t, ndim=2] M = numpy.empty((w, h))
+    cdef numpy.ndarray[numpy.int_t, ndim=2] tmpIy = numpy.empty((w, h),
+                                                    dtype = numpy.int)
+    cdef numpy.ndarray[numpy.int_t, ndim=2] Ix = numpy.empty((w, h),
                                                  dtype = numpy.int)
-    cdef numpy.ndarray[numpy.int_t, ndim=2] Iy = numpy.zeros((w, h), 
+    cdef numpy.ndarray[numpy.int_t, ndim=2] Iy = numpy.empty((w, h),
                                                  dtype = numpy.int)
+    cdef numpy.ndarray[numpy.int_t, ndim=1] v = numpy.empty(n + 1,
+                                                dtype = numpy.int)
+    cdef numpy.ndarray[numpy.double_t, ndim=1] z = numpy.empty(n + 2)
 
-    cdef numpy.ndarray[numpy.double_t, ndim=1] tmpM = numpy.zeros(w*h, 
-                                                      dtype = numpy.double)
-    cdef numpy.ndarray[numpy.int_t, ndim=1] tmpIx = numpy.zeros(w*h, 
-                                                    dtype = numpy.int)
-    cdef numpy.ndarray[numpy.int_t, ndim=1] tmpIy = numpy.zeros(w*h, 
-                                                    dtype = numpy.int)
-
-    for x in range(w):
-        quadratic_1d(vals, tmpM, tmpIy, 1, h, cost, 0, x * h)
+    if w == 0 or h == 0:
+        return M, Ix, Iy
 
-    for y in range(h):
-        quadratic_1d(tmpM, M, tmpIx, h, w, cost, 0, y)
+    cdef double *srcp = <double*>src.data
+    cdef double *tmpMp = <double*>tmpM.data
+    cdef double *Mp = <double*>M.data
+    cdef long *tmpIyp = <long*>tmpIy.data
+    cdef long *Ixp = <long*>Ix.data
+    cdef long *Iyp = <long*>Iy.data
+    cdef long *vp = <long*>v.data
+    cdef double *zp = <double*>z.data
 
-    for x in range(w):
+    # release the GIL so the forward and backward passes can run together
+    with nogil:
+        for x in range(w):
+            transform(srcp + x * h, tmpMp + x * h, tmpIyp + x * h, vp, zp,
+                      1, h, kind, ycost, radius)
         for y in range(h):
-            p = x * h + y
-            Ix[x, y] = tmpIx[p]
-            Iy[x, y] = tmpIy[tmpIx[p]*h+y]
+            transform(tmpMp + y, Mp + y, Ixp + y, vp, zp,
+                      h, w, kind, xcost, radius)
+
+        for x in range(w):
+            for y in range(h):
+                Iyp[x * h + y] = tmpIyp[Ixp[x * h + y] * h + y]
 
-    return M.reshape((w,h)), Ix, Iy
+    return M, Ix, Iy
+
+cdef inline void transform(double *src, double *dst, long *ptr,
+                           long *v, double *z, int step, int n,
+                           int kind, double cost, int radius) nogil:
+    if kind == QUADRATIC:
+        quadratic_kernel(src, dst, ptr, v, z, step, n, cost, 0)
+    elif kind == MANHATTAN:
+        manhattan_kernel(src, dst, ptr, step, n, cost)
+    else:
+        hinge_kernel(src, dst, ptr, v, step, n, radius)
+
+class Quadratic(object):
+    """
+    A pairwise cost of cost * dx^2 + ycost * dy^2. If ycost is not
+    specified, it defaults to cost.
+    """
+    def __init__(self, cost, ycost = None):
+        self.cost = cost
+        self.ycost = cost if ycost is None else ycost
+
+    def __call__(self, scores):
+        return separable(scores, QUADRATIC, self.cost, self.ycost, 0)
+
+    def scaled(self, factor):
+        """
+        Returns the same cost on a grid whose cells are factor times larger.
+        """
+        return Quadratic(self.cost * factor ** 2, self.ycost * factor ** 2)
+
+class Manhattan(object):
+    """
+    A pairwise cost of cost * |dx| + ycost * |dy|. If ycost is not
+    specified, it defaults to cost.
+    """
+    def __init__(self, cost, ycost = None):
+        self.cost = cost
+        self.ycost = cost if ycost is None else ycost
+
+    def __call__(self, scores):
+        return separable(scores, MANHATTAN, self.cost, self.ycost, 0)
+
+    def scaled(self, factor):
+        """
+        Returns the same cost on a grid whose cells are factor times larger.
+        """
+        return Manhattan(self.cost * factor, self.ycost * factor)
+
+class Hinge(object):
+    """
+    A pairwise cost that is free for moves of less than radius cells along
+    each axis and forbidden otherwise.
+    """
+    def __init__(self, radius = 30):
+        self.radius = radius
+
+    def __call__(self, scores):
+        return separable(scores, HINGE, 0, 0, self.radius)
+
+    def scaled(self, factor):
+        """
+        Returns the same cost on a grid whose cells are factor times larger.
+        The radius is rounded up, so no move allowed here is forbidden there.
+        """
+        return Hinge(max(int(ceil(self.radius / float(factor))), 1))
+
+class TruncatedQuadratic(object):
+    """
+    A quadratic pairwise cost that never exceeds truncation, so the object
+    may jump anywhere for a fixed price.
+    """
+    def __init__(self, cost, truncation, ycost = None):
+        self.quadratic = Quadratic(cost, ycost)
+        self.truncation = truncation
+
+    def __call__(self, scores):
+        M, Ix, Iy = self.quadratic(scores)
+        if M.size == 0:
+            return M, Ix, Iy
+        x, y = numpy.unravel_index(numpy.argmin(scores), scores.shape)
+        jump = scores[x, y] + self.truncation
+        cheaper = jump < M
+        M[cheaper] = jump
+        Ix[cheaper] = x
+        Iy[cheaper] = y
+        return M, Ix, Iy
+
+    def scaled(self, factor):
+        """
+        Returns the same cost on a grid whose cells are factor times larger.
+        """
+        quadratic = self.quadratic.scaled(factor)
+        return TruncatedQuadratic(quadratic.cost, self.truncation,
+                                  quadratic.ycost)
+
+# see Pedro Felzenszwalb et. al
+cpdef quadratic_1d(numpy.ndarray[numpy.double_t, ndim=1] src,
+                            numpy.ndarray[numpy.double_t, ndim=1] dst,
+                            numpy.ndarray[numpy.int_t, ndim=1] ptr,
+                            int step, int n, double a, double b, int o):
+    cdef numpy.ndarray[numpy.int_t, ndim=1] v = numpy.zeros(n, dtype=numpy.int)
+    cdef numpy.ndarray[numpy.double_t, ndim=1] z = numpy.zeros(n+1,
+                                                   dtype = numpy.double)
+    quadratic_kernel(<double*>src.data + o, <double*>dst.data + o,
+                     <long*>ptr.data + o, <long*>v.data, <double*>z.data,
+                     step, n, a, b)
+
+# see Pedro Felzenszwalb et. al
+def quadratic(numpy.ndarray[numpy.double_t, ndim=2] scores,
+                       double cost):
+    return Quadratic(cost)(scores)
 
 def manhattan(inscores, incost):
-    cdef int w, h, i, j, ri, rj
-    w, h = inscores.shape
-
-    cdef double cost = incost
-    cdef numpy.ndarray[numpy.double_t, ndim=2] scores = inscores
-
-    cdef numpy.ndarray[numpy.double_t, ndim=2] forward, backward
-    cdef numpy.ndarray[numpy.int_t, ndim=2] forwardxp, forwardyp
-    cdef numpy.ndarray[numpy.int_t, ndim=2] backwardxp, backwardyp
-
-    forward = numpy.zeros((w,h), dtype = numpy.double)
-    forwardxp = numpy.zeros((w,h), dtype = numpy.int)
-    forwardyp = numpy.zeros((w,h), dtype = numpy.int)
-    backward = numpy.zeros((w,h), dtype = numpy.double)
-    backwardxp = numpy.zeros((w,h), dtype = numpy.int)
-    backwardyp = numpy.zeros((w,h), dtype = numpy.int)
-
-    # forward pass
-    for i in range(w):
-        for j in range(h):
-            forward[i, j] = scores[i, j]
-            forwardxp[i, j] = i
-            forwardyp[i, j] = j
-
-            if j-1 >= 0 and forward[i, j-1] + cost < forward[i, j]:
-                forward[i, j] = forward[i, j-1] + cost
-                forwardxp[i, j] = forwardxp[i, j-1]
-                forwardyp[i, j] = forwardyp[i, j-1]
-            if i-1 >= 0 and forward[i-1, j] + cost < forward[i, j]:
-                forward[i, j] = forward[i-1, j] + cost
-                forwardxp[i, j] = forwardxp[i-1, j]
-                forwardyp[i, j] = forwardyp[i-1, j]
-
-    # backwards pass
-    for ri in range(w):
-        i = w - ri - 1
-        for rj in range(h):
-            j = h - rj - 1
-            backward[i, j] = forward[i, j]
-            backwardxp[i, j] = forwardxp[i, j]
-            backwardyp[i, j] = forwardyp[i, j]
-
-            if j+1 < h and backward[i, j+1] + cost < backward[i, j]:
-                backward[i, j] = backward[i, j+1] + cost
-                backwardxp[i, j] = backwardxp[i, j+1]
-                backwardyp[i, j] = backwardyp[i, j+1]
-            if i+1 < w and backward[i+1, j] + cost < backward[i, j]:
-                backward[i, j] = backward[i+1, j] + cost
-                backwardxp[i, j] = backwardxp[i+1, j]
-                backwardyp[i, j] = backwardyp[i+1, j]
-
-    return backward, backwardxp, backwardyp
+    return Manhattan(incost)(inscores)
 
 def hinge(inscores, int radius = 30):
-    cdef int w, h, i, j, pstart, pstop, x, y 
-    w, h = inscores.shape
-
-    cdef numpy.ndarray[numpy.double_t, ndim=2] scores = inscores
-    cdef numpy.ndarray[numpy.double_t, ndim=2] vertical, horizontal
-    cdef numpy.ndarray[numpy.int_t, ndim=2] xp, yp
-
-    vertical = numpy.zeros((w,h), dtype = numpy.double)
-    horizontal = numpy.zeros((w,h), dtype = numpy.double)
-    xp = numpy.zeros((w,h), dtype = numpy.int)
-    yp = numpy.zeros((w,h), dtype = numpy.int)
-
-    for i in range(w):
-        for j in range(h):
-            pstart = j - radius
-            pstop  = j + radius 
-            if pstart < 0:
-                pstart = 0
-            if pstop > h:
-                pstop = h
-            vertical[i, j] = scores[i, j]
-            yp[i, j] = j
-            for y in range(pstart, pstop): 
-                if scores[i, y] < vertical[i, j]:
-                    vertical[i, j] = scores[i, y]
-                    yp[i, j] = y
-
-    for i in range(w):
-        for j in range(h):
-            pstart = i - radius
-            pstop  = i + radius
-            if pstart < 0:
-                pstart = 0
-            if pstop > w:
-                pstop = w
-            horizontal[i, j] = vertical[i, j]
-            xp[i, j] = i
-            for x in range(pstart, pstop):
-                if vertical[x, j] < horizontal[i, j]:
-                    horizontal[i, j] = vertical[x, j]
-                    xp[i, j] = x
-
-    return horizontal, xp, yp
+    return Hinge(radius)(inscores)
+
+def distance(pairwisecost):
+    """
+    Returns the distance transform for a pairwise cost. A number is taken as
+    the cost of a quadratic transform, and anything callable is used as is.
+    """
+    if callable(pairwisecost):
+        return pairwisecost
+    return Quadratic(pairwisecost)